@@ -2,7 +2,7 @@ from fastapi import APIRouter as FastAPIRouter
 from typing import Any, Callable
 
 from Access.api.api_v1.endpoints import (
-    event, record, rule, result, scene, config, punishment, user
+    event, record, rule, result, scene, config, punishment, user, cache
 )
 
 
@@ -51,4 +51,5 @@ api_router.include_router(scene.router, tags=["scene"])
 api_router.include_router(config.router, tags=["config"])
 api_router.include_router(punishment.router, tags=["punishment"])
 api_router.include_router(user.router, tags=["userinfo"])
+api_router.include_router(cache.router, tags=["cache"])
 # api_router.include_router(items.router, prefix="/items", tags=["items"])
@@ -0,0 +1,50 @@
+# @Time : 2026-10-19 01:12:40
+# @Author : Mio Lau
+# @Contact: liurusi.101@gmail.com | github.com/MioYvo
+# @File : cache.py
+from typing import List, Optional
+
+from fastapi import APIRouter, Depends
+from pydantic import BaseModel, Field as PDField
+
+from Access.api.deps import get_current_username_admin
+from model.odm import Handler, Event, Rule, Scene, Record, Result, Config, Punishment, AggData
+from utils.exceptions import RCSExcErrArg
+from utils.fastapi_app import app
+
+router = APIRouter()
+
+CACHED_MODELS = {
+    _model.__name__: _model for _model in [Handler, Event, Rule, Scene, Record, Result, Config, Punishment, AggData]
+}
+
+
+class CacheInvalidationIn(BaseModel):
+    model: Optional[str] = PDField(default=None, title="模型名", description="e.g. `Rule`, all models if empty")
+    ids: List[str] = PDField(default_factory=list, title="主键", description="all instances of `model` if empty")
+
+
+class CacheInvalidationOut(BaseModel):
+    model: Optional[str]
+    deleted: int
+
+
+@router.post("/cache/invalidate/", response_model=CacheInvalidationOut, description="""
+Invalidate cached instances in redis and in the in-process caches of all services, admin only.
+* `model` and `ids`: the instances
+* `model`: all instances of the model
+* nothing: all instances of all models
+""")
+async def invalidate_cache(invalidation: CacheInvalidationIn, handler: Handler = Depends(get_current_username_admin)):
+    model = None
+    if invalidation.model:
+        model = CACHED_MODELS.get(invalidation.model)
+        if not model:
+            raise RCSExcErrArg(content=f"model {invalidation.model} not found")
+    if invalidation.ids:
+        if not model:
+            raise RCSExcErrArg(content="model is required by ids")
+        await app.state.engine.delete_cache_by_keys(model, invalidation.ids)
+        return CacheInvalidationOut(model=invalidation.model, deleted=len(invalidation.ids))
+    deleted = await app.state.engine.clear_cache(model)
+    return CacheInvalidationOut(model=invalidation.model, deleted=deleted)
@@ -49,7 +49,7 @@ class RecordOut(BaseModel):
 
 @router.put("/record/", response_model=RecordOut, status_code=HTTP_201_CREATED)
 async def create_or_update_record(record_in: RecordIn):
-    event: Optional[Event] = await app.state.engine.find_one(Event, Event.name == record_in.event_name)
+    event: Optional[Event] = await app.state.engine.get_by_unique(Event, 'name', record_in.event_name)
     if not event:
         raise RCSExcNotFound(entity_id=str(record_in.event_name))
     # validate event
@@ -77,7 +77,7 @@ async def get_current_username(credentials: HTTPAuthorizationCredentials = Depen
             detail="Not authenticated",
             # headers={"WWW-Authenticate": "Basic"},
         )
-    handler = await app.state.engine.find_one(Handler, Handler.token == credentials.credentials)
+    handler = await app.state.engine.get_by_unique(Handler, 'token', credentials.credentials)
     if not handler:
         raise HTTPException(
             status_code=HTTP_401_UNAUTHORIZED,
@@ -32,7 +32,7 @@ logger.add(Path(LOG_FILE_PATH) / LOG_FILENAME, level=getattr(logging, LOG_LEVEL)
            filter=filter_out_health_check)
 
 from Access.api.api_v1.api import api_router
-from Access.api.health import router as health_router
+from utils.health import router as health_router
 app.docs_url = None
 app.add_middleware(
     CORSMiddleware,
@@ -6,11 +6,13 @@ sys.path.insert(0, str(Path().absolute().parent))
 
 from DataProcessor.processer.access import AccessConsumer
 from utils.mpika import make_consumer
+from utils.ruleset import ruleset
 from config import PROJECT_NAME, DATA_PROCESSOR_QUEUE_NAME, RCSExchangeName, PRE_FETCH_COUNT, LOG_FILE_PATH, \
-    LOG_FILENAME, LOG_FILE_RETENTION, LOG_FILE_ROTATION
+    LOG_FILENAME, LOG_FILE_RETENTION, LOG_FILE_ROTATION, RULESET_SNAPSHOT_ENABLE
 from utils.fastapi_app import app
 from utils.logger import format_record, InterceptHandler
 from SceneScript import scripts_manager
+from utils.health import router as health_router
 logging.getLogger().handlers = [InterceptHandler()]
 logger.configure(
     handlers=[{"sink": sys.stdout, "level": logging.INFO, "format": format_record}]
@@ -18,9 +20,18 @@ logger.configure(
 logging.getLogger("uvicorn.access").handlers = [InterceptHandler()]
 logger.add(Path(LOG_FILE_PATH) / LOG_FILENAME, retention=LOG_FILE_RETENTION, rotation=LOG_FILE_ROTATION)
 
+app.include_router(health_router, prefix="/api", tags=["health"])
+
 
 @app.on_event("startup")
 async def startup_event():
+    app.state.engine.invalidation_callbacks.append(ruleset.invalidate)
+    if RULESET_SNAPSHOT_ENABLE:
+        # from the warmed-up caches, before the first record
+        try:
+            await ruleset.current()
+        except Exception as e:
+            logger.exception(e)
     app.state.consumer = AccessConsumer(amqp_connection=app.state.amqp_connection)
     dp_consumers, app.state.dp_consumer_channels = await make_consumer(
         amqp_connection=app.state.amqp_connection,
@@ -40,6 +51,9 @@ async def register_scene():
 
 @app.on_event("shutdown")
 async def shutdown_event():
+    # insert held records before their messages' channels are closed
+    if app.state.consumer.record_writer:
+        await app.state.consumer.record_writer.close()
     for channel in app.state.dp_consumer_channels:
         if not channel.is_closed:
             logger.info(f'Channel closing: {channel}')
@@ -1,28 +1,69 @@
+import asyncio
 import datetime
-from copy import deepcopy
-from typing import Optional, Set
+from typing import List, Optional, Set, Union
 
 import loguru
 from aio_pika import IncomingMessage
 from odmantic import ObjectId
-from pymongo.errors import DuplicateKeyError
-from pymongo.results import UpdateResult
+from pymongo.errors import BulkWriteError, DuplicateKeyError, WriteError
 from schema import SchemaError
 
-from config import RCSExchangeName, RULE_EXE_ROUTING_KEY, DATA_PROCESSOR_ROUTING_KEY
-from model.odm import Event, Record, Rule, Status, ResultInRecord
+from config import RCSExchangeName, RULE_EXE_ROUTING_KEY, DATA_PROCESSOR_ROUTING_KEY, RULE_RENDER_IN_EXECUTOR, \
+    AGG_DATA_ENABLE, RULESET_SNAPSHOT_ENABLE, DATA_PROCESSOR_BATCH_ENABLE, DATA_PROCESSOR_BATCH_SIZE, \
+    DATA_PROCESSOR_BATCH_DELAY, DATA_PROCESSOR_DISPATCH_CONCURRENCY, RULE_DISPATCH_ENVELOPE
+from model.odm import Event, Record, Rule, Status, ResultInRecord, AggData
 from utils.amqp_consumer import AmqpConsumer
-from utils.amqp_publisher import publisher
+from utils.amqp_publisher import AmqpPublisher
+from utils.batcher import MicroBatcher
 from utils.gtz import Dt
 from utils.logger import Logger
 from utils.fastapi_app import app
-from utils.rule_operator import RuleParser
+from utils.rule_compiler import RuleCompiler
+from utils.ruleset import ruleset
+from utils.window_store import window_store
 
 
 class AccessConsumer(AmqpConsumer):
     logger = Logger(name='AccessConsumer')
     routing_key = DATA_PROCESSOR_ROUTING_KEY
 
+    def __init__(self, amqp_connection):
+        super(AccessConsumer, self).__init__(amqp_connection)
+        self.record_writer: Optional[MicroBatcher] = MicroBatcher(
+            self.insert_records, max_size=DATA_PROCESSOR_BATCH_SIZE, max_delay=DATA_PROCESSOR_BATCH_DELAY
+        ) if DATA_PROCESSOR_BATCH_ENABLE else None
+
+    def parse_message(self, message) -> Optional[Record]:
+        try:
+            return Record.parse_raw(message.body)
+        except Exception as e:
+            self.logger.exceptions(e)
+            return None
+
+    async def insert_records(self, records: List[Record]) -> List[Union[Record, Exception]]:
+        """
+        Validate a batch of records and insert them with one unordered insert_many
+        :return: the record or the error of each record, e.g. DuplicateKeyError of `idx_event_data_order_no_1`
+        """
+        events = await app.state.engine.get_by_ids(Event, list({record.event for record in records}))
+        event_ids = {event.id for event in events if event}
+        rst: List[Union[Record, Exception]] = [
+            record if record.event in event_ids else SchemaError(f'{Event.__name__} {record.event} not found')
+            for record in records
+        ]
+
+        valid = [i for i, record in enumerate(rst) if isinstance(record, Record)]
+        if valid:
+            try:
+                await app.state.engine.get_collection(Record).insert_many(
+                    [records[i].doc() for i in valid], ordered=False)
+            except BulkWriteError as e:
+                for error in e.details.get('writeErrors', []):
+                    exc_class = DuplicateKeyError if error.get('code') == 11000 else WriteError
+                    rst[valid[error['index']]] = exc_class(error.get('errmsg'), error.get('code'), error)
+        self.logger.info("InsertMany", collection=Record.__name__, size=len(records), valid=len(valid))
+        return rst
+
     async def validate_message(self, message) -> Optional[Record]:
         try:
             record: Record = Record.parse_raw(message.body)
@@ -38,12 +79,33 @@ class AccessConsumer(AmqpConsumer):
             return record
 
     async def consume(self, message: IncomingMessage):
-        record = await self.validate_message(message=message)
+        if self.record_writer:
+            record = self.parse_message(message=message)
+        else:
+            record = await self.validate_message(message=message)
         if not record:
             return await self.ack(message)
 
+        # results are resolved before the record is inserted, so it's written once
+        try:
+            rules = await self.resolve_rules(record)
+        except Exception as e:
+            # the record is still inserted, without results, as before rules were resolved first
+            self.logger.exceptions(e, where='resolve_rules', record=record.id)
+            rules = []
+            record.results = []
+
+        if self.record_writer:
+            # validated and inserted with records of other messages
+            insert = self.record_writer.submit(record)
+        else:
+            insert = app.state.engine.save(record)
+
         try:
-            record = await app.state.engine.save(record)
+            record = await insert
+        except SchemaError as e:
+            self.logger.exceptions(e)
+            await self.ack(message)
         except DuplicateKeyError as e:
             self.logger.info("InsertFailedDuplicateKey", collection=Record.__name__, e=e.details)
             await self.ack(message)
@@ -53,12 +115,46 @@ class AccessConsumer(AmqpConsumer):
         else:
             # rst: InsertOneResult = await record_collection.insert_one(data)
             self.logger.info("InsertSuccess", collection=Record, doc=record.id)
+            await window_store.incr(record)
+            if AGG_DATA_ENABLE:
+                try:
+                    await AggData.incr(
+                        record, scenes=await ruleset.scenes(record.event) if RULESET_SNAPSHOT_ENABLE else None)
+                except Exception as e:
+                    self.logger.exceptions(e, where='AggData.incr', record=record.id)
             # doc = await record_collection.find_one(rst.inserted_id)
             # self.logger.info(record)
             await self.ack(message)
-            await self.dispatch_to_rule_executor(record)
+            await self.dispatch_to_rule_executor(record, rules)
+
+    async def resolve_rules(self, record: Record) -> List[Rule]:
+        """
+        Effective rules of the record, set as `record.results` dispatched now
+        :param record: not inserted yet
+        :return:
+        """
+        if RULESET_SNAPSHOT_ENABLE:
+            _rules = await ruleset.rules(record.event, record.user.project)
+        else:
+            rules: Set[ObjectId] = await record.rules()
+            # if len(rules) != len(rules):
+            #     await self.update_rules(rules, event=record.event)
+            _rules = await app.state.engine.find(
+                Rule,
+                Rule.id.in_(list(rules)),
+                Rule.status == Status.ON,
+                {"project": {"$elemMatch": {"$eq": record.user.project}}}
+            )
+            self.logger.info(f'no such effective rules: {rules - {_r.id for _r in _rules}}')
+
+        dispatch_time = datetime.datetime.utcnow()
+        record.results = [
+            ResultInRecord(rule_id=_rule.id, punish_level=_rule.punish_level, dispatch_time=dispatch_time)
+            for _rule in _rules
+        ]
+        return _rules
 
-    async def dispatch_to_rule_executor(self, record: Record):
+    async def dispatch_to_rule_executor(self, record: Record, rules: List[Rule]):
         """
         {
             "trigger_by": {
@@ -84,59 +180,59 @@ class AccessConsumer(AmqpConsumer):
                 }
             ]
         }
-        :param record:
+        :param record: inserted with `results` of `rules`
+        :param rules: from `resolve_rules`
         :return:
         """
-        rules: Set[ObjectId] = await record.rules()
-        # if len(rules) != len(rules):
-        #     await self.update_rules(rules, event=record.event)
-        _rules = await app.state.engine.find(
-            Rule,
-            Rule.id.in_(list(rules)),
-            Rule.status == Status.ON,
-            {"project": {"$elemMatch": {"$eq": record.user.project}}}
-        )
-        self.logger.info(f'no such effective rules: {rules - {_r.id for _r in _rules}}')
-
-        record.results = [ResultInRecord(rule_id=_rule.id, punish_level=_rule.punish_level) for _rule in _rules]
-        await app.state.engine.save(record)
-
-        for _rule in _rules:
-            _rule: Rule
-            _rule_name = _rule.name
-            _rule_id = _rule.id
-            _record_id = record.id
-
-            _rule_schema = await RuleParser.render_rule(deepcopy(_rule.rule), record)
-            if not isinstance(_rule_schema, list):
-                _rule_schema = [_rule_schema]
-
-            loguru.logger.info(f"{_rule_schema=}")
+        semaphore = asyncio.Semaphore(DATA_PROCESSOR_DISPATCH_CONCURRENCY)
 
+        async def _message(_rule: Rule) -> dict:
             data = {
-                "record": _record_id,
-                "rule": _rule_id,
-                "rule_schema": _rule_schema
+                "record": record.id,
+                "rule": _rule.id,
             }
-            await self.update_results(record_id=_record_id, rule_id=_rule_id)
-            tf, rst, sent_msg = await publisher(
-                conn=self.amqp_connection,
+            if RULE_RENDER_IN_EXECUTOR:
+                return data
+            async with semaphore:
+                try:
+                    _rule_schema = await RuleCompiler.render(_rule, record)
+                except Exception as e:
+                    # isolated per rule, RuleEngine renders it again
+                    self.logger.exceptions(e, where='render_rule', rule=_rule.id, record=record.id)
+                else:
+                    loguru.logger.info(f"{_rule_schema=}")
+                    data["rule_schema"] = _rule_schema
+                    # version of the rule rendered, RuleEngine evaluates it compiled only if it's the same
+                    data["rule_hash"] = RuleCompiler.hash_of(_rule)
+            return data
+
+        # renders overlap, latency is the slowest rule instead of the sum of all
+        messages = await asyncio.gather(*[_message(_rule) for _rule in rules])
+
+        confirms, envelope = [], []
+        for _rule, data in zip(rules, messages):
+            if RULE_DISPATCH_ENVELOPE:
+                envelope.append({k: v for k, v in data.items() if k != "record"})
+                continue
+            # confirms are pipelined, checked after all rules are published
+            confirms.append((_rule.name, AmqpPublisher.of(self.amqp_connection).publish_nowait(
                 message=data, exchange_name=RCSExchangeName,
                 routing_key=RULE_EXE_ROUTING_KEY, timestamp=Dt.now_ts(),
-            )
+            )))
+
+        if envelope:
+            # all rules of the record in one message, see RULE_DISPATCH_ENVELOPE
+            confirms.append((f"{len(envelope)} rules", AmqpPublisher.of(self.amqp_connection).publish_nowait(
+                message={"record": record.id, "rules": envelope}, exchange_name=RCSExchangeName,
+                routing_key=RULE_EXE_ROUTING_KEY, timestamp=Dt.now_ts(),
+            )))
+
+        for _rule_name, confirm in confirms:
+            tf, rst, sent_msg = await confirm
             if tf:
-                self.logger.info('publishSuccess', routing_key=RULE_EXE_ROUTING_KEY, rule=_rule_name, record=_record_id)
+                self.logger.info('publishSuccess', routing_key=RULE_EXE_ROUTING_KEY, rule=_rule_name, record=record.id)
             else:
-                self.logger.error('publishFailed', routing_key=RULE_EXE_ROUTING_KEY, rule=_rule_name, record=_record_id)
-
-    async def update_results(self, record_id: ObjectId, rule_id: ObjectId):
-        rst: UpdateResult = await app.state.engine.update_one(
-            Record,
-            {"_id": record_id, "results.rule_id": rule_id},
-            update={"$set": {
-                "results.$.dispatch_time": datetime.datetime.utcnow()
-            }}
-        )
+                self.logger.error('publishFailed', routing_key=RULE_EXE_ROUTING_KEY, rule=_rule_name, record=record.id)
 
     @staticmethod
     async def update_rules(rules, event: Event):
@@ -1,26 +1,40 @@
 # __author__ = "Mio"
 # __email__: "liurusi.101@gmail.com"
 # created: 3/31/21 4:54 AM
+import asyncio
 import datetime
 import json
-from typing import Optional
+from typing import Dict, List, Optional, Tuple, Union
 
 from aio_pika import IncomingMessage
 from bson import ObjectId
-from schema import Schema, SchemaError, Use
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, WriteError
+from schema import Optional as SchemaOptional, Schema, SchemaError, Use
 
-from model.odm import Record, Rule, Result, ResultInRecordStatus, \
-    suggest_final_punishment
+from model.odm import Record, Rule, Result, ResultInRecordStatus, MAX_PUNISH_LEVEL, \
+    suggest_final_punishment, suggest_final_punishment_expression
 from utils.fastapi_app import app
 from utils.rule_operator import RuleParser
-from config import RULE_EXE_ROUTING_KEY
+from utils.rule_compiler import RuleCompiler, RuleShapeError
+from config import RULE_EXE_ROUTING_KEY, MONGO_PIPELINE_UPDATE, RULE_EXE_BATCH_ENABLE, RULE_EXE_BATCH_SIZE, \
+    RULE_EXE_BATCH_DELAY, RULE_EXE_CONCURRENCY, RULE_EARLY_TERMINATION
 from utils.amqp_consumer import AmqpConsumer
+from utils.batcher import MicroBatcher
 from utils.logger import Logger
 
 
 class RuleExecutorConsumer(AmqpConsumer):
     logger = Logger(name='RuleExecutorConsumer')
     routing_key = RULE_EXE_ROUTING_KEY
+    # results not finalized yet
+    pending_statuses = [ResultInRecordStatus.WAIT, ResultInRecordStatus.DISPATCHED]
+
+    def __init__(self, amqp_connection):
+        super(RuleExecutorConsumer, self).__init__(amqp_connection)
+        self.result_writer: Optional[MicroBatcher] = MicroBatcher(
+            self.flush_results, max_size=RULE_EXE_BATCH_SIZE, max_delay=RULE_EXE_BATCH_DELAY
+        ) if RULE_EXE_BATCH_ENABLE else None
 
     async def consume(self, message: IncomingMessage):
         """
@@ -54,30 +68,33 @@ class RuleExecutorConsumer(AmqpConsumer):
         data = await self.validate_message(message=message)
         if not data:
             return await self.ack(message)
+        elif 'rules' in data:
+            return await self.consume_envelope(message=message, data=data)
         else:
             record: Record = await app.state.engine.get_by_id(Record, data['record'])
             rule: Rule = await app.state.engine.get_by_id(Rule, data['rule'])
-            rule_schema: list = data['rule_schema']
+            rule_schema: Optional[list] = data.get('rule_schema')
+            rule_hash: Optional[str] = data.get('rule_hash')
 
             if not (rule and record):
                 return await self.ack(message)
+            if RULE_EARLY_TERMINATION and record.punish.reached_max():
+                await self.skip_remaining(record)
+                return await self.ack(message)
 
         # self.logger.info(trigger_by=record.id, event=record.event.name, rule_name=rule.name)
         try:
-            if RuleParser.evaluate_rule(rule_schema):
-                # rule matched
-                self.logger.info('✓RuleMatched✓', rule_id=rule.id, rule_name=rule.name)
-                result = Result(rule=rule.id, record=record.id, processed=False)
-                await app.state.engine.save(result)
-            else:
-                # rule not matched
-                self.logger.info('✗RuleNotMatch✗', rule_id=rule.id, rule_name=rule.name, rule=rule.name)
-                result = None
+            result = await self.execute(record, rule, rule_schema, rule_hash)
         except Exception as e:
             self.logger.exceptions(e, where='render_rule')
             await self.reject(message, requeue=False)
         else:
-            await self.update_results_in_record(record=record, rule=rule, result=result)
+            try:
+                await self.write_result(record=record, rule=rule, result=result)
+            except Exception as e:
+                # not written, deliver it again
+                self.logger.exceptions(e, where='write_result')
+                await self.reject(message, requeue=True)
         finally:
             try:
                 # may rejected msg before this
@@ -85,6 +102,204 @@ class RuleExecutorConsumer(AmqpConsumer):
             except Exception as e:
                 self.logger.debug(e, where='ack msg')
 
+    async def consume_envelope(self, message: IncomingMessage, data: dict):
+        """
+        All rules of one record: {"record": id, "rules": [{"rule": id, "rule_schema": [...]}, ...]}.
+        Rules are evaluated concurrently with one Record fetch, Results are inserted at once and Record.results is
+        finalized by one update. Rules failed to evaluate are left undone, like rejected single rule messages.
+        """
+        record: Record = await app.state.engine.get_by_id(Record, data['record'])
+        if not record:
+            return await self.ack(message)
+        if RULE_EARLY_TERMINATION and record.punish.reached_max():
+            await self.skip_remaining(record)
+            return await self.ack(message)
+        items = data['rules']
+        rules = await app.state.engine.get_by_ids(Rule, [item['rule'] for item in items])
+        semaphore = asyncio.Semaphore(RULE_EXE_CONCURRENCY)
+        hit_punish_level = record.punish.hit_punish_level
+
+        async def _execute(rule: Rule, rule_schema: Optional[list], rule_hash: Optional[str]):
+            nonlocal hit_punish_level
+            async with semaphore:
+                if RULE_EARLY_TERMINATION and hit_punish_level >= MAX_PUNISH_LEVEL:
+                    # left pending, skipped by `skip_remaining_stage` or `finalize_actions` of the outcomes' write
+                    return None
+                try:
+                    result = await self.execute(record, rule, rule_schema, rule_hash)
+                except Exception as e:
+                    self.logger.exceptions(e, where='render_rule', rule=rule.id)
+                    return None
+                if result:
+                    hit_punish_level += rule.punish_level
+                return rule, result
+
+        outcomes = await asyncio.gather(*[
+            _execute(rule, item.get('rule_schema'), item.get('rule_hash')) for rule, item in zip(rules, items) if rule
+        ])
+        outcomes = [outcome for outcome in outcomes if outcome]
+        try:
+            if outcomes:
+                await self.write_results(record=record, outcomes=outcomes)
+        except Exception as e:
+            # not written, deliver it again
+            self.logger.exceptions(e, where='write_results')
+            await self.reject(message, requeue=True)
+        else:
+            await self.ack(message)
+
+    async def execute(self, record: Record, rule: Rule, rule_schema: Optional[list] = None,
+                      rule_hash: Optional[str] = None) -> Optional[Result]:
+        """
+        Render (if not rendered by DataProcessor) and evaluate a rule
+        :param rule_hash: `RuleCompiler.hash_of` the rule `rule_schema` was rendered from
+        :return: Result if matched, not saved yet
+        """
+        if rule_schema is None:
+            # published without rendering, see RULE_RENDER_IN_EXECUTOR
+            rule_schema = await RuleCompiler.render(rule, record)
+            rule_hash = None
+        if self.evaluate(rule, rule_schema, rule_hash):
+            # rule matched
+            self.logger.info('✓RuleMatched✓', rule_id=rule.id, rule_name=rule.name)
+            return Result(id=Result.id_of(record.id, rule.id), rule=rule.id, record=record.id, processed=False)
+        else:
+            # rule not matched
+            self.logger.info('✗RuleNotMatch✗', rule_id=rule.id, rule_name=rule.name, rule=rule.name)
+            return None
+
+    async def write_results(self, record: Record, outcomes: List[Tuple[Rule, Optional[Result]]]):
+        """
+        Finalize Record.results with one update, or one bulk_write of positional updates without pipeline updates,
+        then insert the applied Results with one bulk_write
+        """
+        if MONGO_PIPELINE_UPDATE:
+            updated = await app.state.engine.find_one_and_update_by_id(
+                Record, record.id, query=self.finalizable_query(*[rule for rule, _ in outcomes]),
+                update=self.results_in_record_update(outcomes))
+            if updated:
+                self.logger.info(updated.id, updated.punish.log_status(), total=len(updated.results))
+            else:
+                self.logger.info(f"{Record} not fund")
+        else:
+            # a positional update finalizes one result, one UpdateOne per rule
+            await app.state.engine.get_collection(Record).bulk_write([
+                UpdateOne(
+                    {"_id": record.id, **self.finalizable_query(rule)}, self.result_in_record_update(rule, result)
+                ) for rule, result in outcomes
+            ], ordered=False)
+            await app.state.engine.delete_cache_by_key(Record, record.id)
+            await self.finalize_actions([record.id])
+
+        errors = await self.insert_applied_results([result for _, result in outcomes if result])
+        if any(errors):
+            raise next(error for error in errors if error)
+
+    async def write_result(self, record: Record, rule: Rule, result: Optional[Result] = None):
+        """
+        Update Record.results and save the Result if matched and applied, returns after the writes are done
+        """
+        if self.result_writer:
+            return await self.result_writer.submit((record, rule, result))
+        await self.update_results_in_record(record=record, rule=rule, result=result)
+        if result:
+            errors = await self.insert_applied_results([result])
+            if errors[0]:
+                raise errors[0]
+
+    @staticmethod
+    async def insert_results(results: List[Result]) -> List[Optional[BaseException]]:
+        """
+        Insert Results with one unordered bulk_write, idempotent by (record, rule): a Result of a redelivered
+        message is not inserted again
+        :return: None or the error of each result
+        """
+        errors: List[Optional[BaseException]] = [None] * len(results)
+        if not results:
+            return errors
+        try:
+            await app.state.engine.get_collection(Result).bulk_write([
+                UpdateOne({"record": result.record, "rule": result.rule}, {"$setOnInsert": result.doc()}, upsert=True)
+                for result in results
+            ], ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get('writeErrors', []):
+                if error.get('code') == 11000:
+                    # upserted concurrently by another delivery
+                    continue
+                errors[error['index']] = WriteError(error.get('errmsg'), error.get('code'), error)
+        return errors
+
+    async def insert_applied_results(self, results: List[Result]) -> List[Optional[BaseException]]:
+        """
+        `insert_results` of the Results their records refer to, called after the records are updated: an update
+        excluded by `finalizable_query` (done by an earlier delivery, or the record was terminated early) leaves no
+        orphan Result, while the redelivery of a message whose insert failed still inserts it as ids are deterministic
+        :return: None or the error of each result
+        """
+        errors: List[Optional[BaseException]] = [None] * len(results)
+        if not results:
+            return errors
+        applied = set()
+        async for doc in app.state.engine.get_collection(Record).find(
+                {"_id": {"$in": list({result.record for result in results})},
+                 "results.result_id": {"$in": [result.id for result in results]}},
+                projection={"results.result_id": 1}):
+            applied.update(r.get('result_id') for r in doc.get('results') or [])
+        inserts = [i for i, result in enumerate(results) if result.id in applied]
+        for i, error in zip(inserts, await self.insert_results([results[i] for i in inserts])):
+            errors[i] = error
+        return errors
+
+    async def flush_results(
+            self, items: List[Tuple[Record, Rule, Optional[Result]]]) -> List[Optional[BaseException]]:
+        """
+        Write a batch of `write_result` with one unordered bulk_write of Records and one of the applied Results.
+        Without pipeline updates `punish.action` of the records is set by `finalize_actions` after the bulk_write.
+        Messages of failed writes are delivered again.
+        :return: None or the error of each item
+        """
+        errors: List[Optional[BaseException]] = [None] * len(items)
+        try:
+            await app.state.engine.get_collection(Record).bulk_write([
+                UpdateOne(
+                    {"_id": record.id, **self.finalizable_query(rule)}, self.result_in_record_update(rule, result)
+                ) for record, rule, result in items
+            ], ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get('writeErrors', []):
+                errors[error['index']] = WriteError(error.get('errmsg'), error.get('code'), error)
+        record_ids = list({record.id for record, _, _ in items})
+        await app.state.engine.delete_cache_by_keys(Record, record_ids)
+        if not MONGO_PIPELINE_UPDATE:
+            await self.finalize_actions(record_ids)
+
+        inserts = [(i, result) for i, (_, _, result) in enumerate(items) if result and errors[i] is None]
+        for (i, _), error in zip(inserts, await self.insert_applied_results([result for _, result in inserts])):
+            errors[i] = error
+        self.logger.info('ResultsFlushed', size=len(items), results=len(inserts),
+                         errors=len([error for error in errors if error]))
+        return errors
+
+    def evaluate(self, rule: Rule, rule_schema: list, rule_hash: Optional[str] = None) -> bool:
+        """
+        Evaluate rendered rule by the compiled rule, which is cached by the hash of the rule
+        :param rule:
+        :param rule_schema: rule rendered by DataProcessor
+        :param rule_hash: hash of the rule `rule_schema` was rendered from
+        :return:
+        """
+        if rule_hash is not None and rule_hash != RuleCompiler.hash_of(rule):
+            # rule updated after dispatching, constants of the compiled rule are not the rendered ones
+            self.logger.info('RuleChanged', rule_id=rule.id)
+            return RuleParser.evaluate_rule(rule_schema)
+        try:
+            return RuleCompiler.get(rule).evaluate(rule_schema)
+        except RuleShapeError as e:
+            # rule updated after dispatching, fall back to interpret the rendered rule
+            self.logger.info('RuleShapeMismatch', rule_id=rule.id, e=e)
+            return RuleParser.evaluate_rule(rule_schema)
+
     async def update_results_in_record(self, record: Record, rule: Rule, result: Optional[Result] = None):
         """
         Update Record.results, which is rule-result mapping
@@ -94,38 +309,210 @@ class RuleExecutorConsumer(AmqpConsumer):
         :return:
         """
 
+        if MONGO_PIPELINE_UPDATE:
+            record = await self.finalize_result_in_record(record=record, rule=rule, result=result)
+            if record:
+                self.logger.info(record.id, record.punish.log_status(), total=len(record.results))
+                if record.punish.results_done == len(record.results):
+                    self.logger.info(f"suggest:punish", record.punish.log_status(), total=len(record.results))
+            else:
+                self.logger.info(f"{Record} not fund")
+            return
+
+        updated = await app.state.engine.find_one_and_update(
+            Record, {"_id": record.id, **self.finalizable_query(rule)},
+            update=self.result_in_record_update(rule, result)
+        )
+        if updated:
+            self.logger.info(updated.id, updated.punish.log_status(), total=len(updated.results))
+        else:
+            self.logger.info(f"{Record} not fund")
+        # also when not updated: the record may be at MAX_PUNISH_LEVEL with this rule left pending
+        await self.finalize_actions([record.id])
+            # return app.state.engine.find_one(Record, Record.id == record.id)
+
+            # self.logger.info(f"update_results", modified_count=rst.modified_count, rule=rule.id,
+            #                  result=True if result else False)
+
+    @staticmethod
+    async def finalize_result_in_record(record: Record, rule: Rule, result: Optional[Result] = None) -> Optional[Record]:
+        """
+        `update_results_in_record` in one pipeline update: sets the rule's result, increases punish levels and,
+        when it's the last result, sets `punish.action` server-side as `suggest_final_punishment` does
+        :return: updated record
+        """
+        return await app.state.engine.find_one_and_update_by_id(
+            Record, record.id, query=RuleExecutorConsumer.finalizable_query(rule),
+            update=RuleExecutorConsumer.results_in_record_update([(rule, result)])
+        )
+
+    @classmethod
+    def result_in_record_update(cls, rule: Rule, result: Optional[Result] = None) -> Union[Dict, List[Dict]]:
+        """
+        Update of one rule's result in a record matched by `finalizable_query(rule)`: the pipeline update of
+        `results_in_record_update`, or a positional update leaving `punish.action` to `finalize_actions`
+        """
+        if MONGO_PIPELINE_UPDATE:
+            return cls.results_in_record_update([(rule, result)])
         inc = {
             "punish.total_punish_level": rule.punish_level, "punish.results_done": 1,
         }
         if result:
             inc["punish.hit_punish_level"] = rule.punish_level
+        return {
+            "$set": {
+                "results.$.status": ResultInRecordStatus.HIT if result else ResultInRecordStatus.DONE,
+                "results.$.done_time": datetime.datetime.utcnow(),
+                "results.$.result_id": result.id if result else None
+            },
+            "$inc": inc
+        }
 
-        record = await app.state.engine.find_one_and_update(
-            Record, {"_id": record.id, "results.rule_id": rule.id},
-            update={
-                "$set": {
-                    "results.$.status": ResultInRecordStatus.HIT if result else ResultInRecordStatus.DONE,
-                    "results.$.done_time": datetime.datetime.utcnow(),
-                    "results.$.result_id": result.id if result else None
-                },
-                "$inc": inc
+    async def finalize_actions(self, record_ids: List[ObjectId]) -> None:
+        """
+        `skip_remaining_stage` and `final_action_stage` without pipeline updates: read back the records after their
+        positional updates, skip the pending results of those at MAX_PUNISH_LEVEL (whose updates the filter excludes
+        from now on) and set `punish.action` of those whose results are all done, with one bulk_write
+        """
+        collection = app.state.engine.get_collection(Record)
+        updates, updated_ids = [], []
+        async for doc in collection.find({"_id": {"$in": record_ids}}, projection={"punish": 1, "results.status": 1}):
+            punish = doc.get('punish') or {}
+            results = doc.get('results') or []
+            hit_punish_level = punish.get('hit_punish_level', 0)
+            action = suggest_final_punishment(hit_punish_level)
+            if RULE_EARLY_TERMINATION and hit_punish_level >= MAX_PUNISH_LEVEL and \
+                    any(r.get('status') in self.pending_statuses for r in results):
+                updates.append(UpdateOne({"_id": doc['_id']}, {"$set": {
+                    "results.$[r].status": ResultInRecordStatus.SKIPPED,
+                    "results.$[r].done_time": datetime.datetime.utcnow(),
+                    "punish.results_done": len(results),
+                    "punish.action": action,
+                }}, array_filters=[{"r.status": {"$in": self.pending_statuses}}]))
+            elif punish.get('results_done', 0) >= len(results) and action and action != punish.get('action'):
+                updates.append(UpdateOne({"_id": doc['_id']}, {"$set": {"punish.action": action}}))
+            else:
+                continue
+            updated_ids.append(doc['_id'])
+        if updates:
+            await collection.bulk_write(updates, ordered=False)
+            await app.state.engine.delete_cache_by_keys(Record, updated_ids)
+        self.logger.info('ActionsFinalized', records=len(record_ids), actions=len(updates))
+
+    @classmethod
+    def finalizable_query(cls, *rules: Rule) -> dict:
+        """
+        Filter of the record to finalize results of `rules` in: some of their results are still pending, so a
+        redelivered message doesn't count them twice, and records terminated early are not updated any more
+        """
+        query = {}
+        if rules:
+            query["results"] = {"$elemMatch": {
+                "rule_id": rules[0].id if len(rules) == 1 else {"$in": [rule.id for rule in rules]},
+                "status": {"$in": cls.pending_statuses},
+            }}
+        if RULE_EARLY_TERMINATION:
+            query["punish.hit_punish_level"] = {"$lt": MAX_PUNISH_LEVEL}
+        return query
+
+    async def skip_remaining(self, record: Record) -> None:
+        """
+        Record reached MAX_PUNISH_LEVEL, no more rules can change its action: mark the pending results skipped and
+        finalize it without rendering or evaluating them
+        """
+        if record.punish.results_done >= len(record.results):
+            return
+        update = [self.skip_remaining_stage(), self.final_action_stage()] if MONGO_PIPELINE_UPDATE else {
+            "$set": {
+                "results.$[r].status": ResultInRecordStatus.SKIPPED,
+                "results.$[r].done_time": datetime.datetime.utcnow(),
+                "punish.results_done": len(record.results),
+                "punish.action": suggest_final_punishment(record.punish.hit_punish_level),
             }
+        }
+        await app.state.engine.get_collection(Record).update_one(
+            {"_id": record.id}, update,
+            array_filters=None if MONGO_PIPELINE_UPDATE else [{"r.status": {"$in": self.pending_statuses}}]
         )
-        if record:
-            self.logger.info(record.id, record.punish.log_status(), total=len(record.results))
-            # record = await app.state.engine.refresh(record)
-            if record.punish.results_done == len(record.results):
-                action = suggest_final_punishment(record.punish.hit_punish_level)
-                if action:
-                    record = await app.state.engine.find_one_and_update(Record, Record.id == record.id,
-                                                                        {"$set": {"punish.action": action}})
-                self.logger.info(f"suggest:punish", record.punish.log_status(), total=len(record.results))
-        else:
-            self.logger.info(f"{Record} not fund")
-            # return app.state.engine.find_one(Record, Record.id == record.id)
+        await app.state.engine.delete_cache_by_key(Record, record.id)
+        self.logger.info('EarlyTerminated', record=record.id, hit_punish_level=record.punish.hit_punish_level)
 
-            # self.logger.info(f"update_results", modified_count=rst.modified_count, rule=rule.id,
-            #                  result=True if result else False)
+    @classmethod
+    def skip_remaining_stage(cls) -> Dict:
+        """
+        Pipeline stage of `skip_remaining`, applied only if the record reached MAX_PUNISH_LEVEL
+        """
+        reached_max = {"$gte": ["$punish.hit_punish_level", MAX_PUNISH_LEVEL]}
+        return {"$set": {
+            "results": {"$cond": [reached_max, {"$map": {
+                "input": "$results", "as": "r",
+                "in": {"$cond": [
+                    {"$in": ["$$r.status", cls.pending_statuses]},
+                    {"$mergeObjects": ["$$r", {
+                        "status": ResultInRecordStatus.SKIPPED, "done_time": datetime.datetime.utcnow()
+                    }]},
+                    "$$r"
+                ]}
+            }}, "$results"]},
+            "punish.results_done": {"$cond": [reached_max, {"$size": "$results"}, "$punish.results_done"]},
+        }}
+
+    @staticmethod
+    def final_action_stage() -> Dict:
+        """
+        Pipeline stage setting `punish.action` as `suggest_final_punishment` does once all results are done
+        """
+        return {"$set": {
+            "punish.action": {"$cond": [
+                {"$eq": ["$punish.results_done", {"$size": "$results"}]},
+                suggest_final_punishment_expression("$punish.hit_punish_level", "$punish.action"),
+                "$punish.action"
+            ]}
+        }}
+
+    @classmethod
+    def results_in_record_update(cls, outcomes: List[Tuple[Rule, Optional[Result]]]) -> List[Dict]:
+        """
+        Pipeline update of `finalize_result_in_record` for results of one or more rules of a record.
+        Only pending results are finalized and counted, results already done by an earlier delivery are kept.
+        :param outcomes: (rule, Result if matched)
+        """
+        done_time = datetime.datetime.utcnow()
+
+        def pending(r, rule: Rule) -> dict:
+            return {"$and": [{"$eq": [f"{r}.rule_id", rule.id]}, {"$in": [f"{r}.status", cls.pending_statuses]}]}
+
+        # expressions of a stage read the document before the stage, i.e. before results are finalized
+        is_pending = {rule.id: {"$gt": [{"$size": {"$filter": {
+            "input": "$results", "as": "p", "cond": pending("$$p", rule)
+        }}}, 0]} for rule, _ in outcomes}
+        return [
+            {"$set": {
+                "results": {"$map": {
+                    "input": "$results", "as": "r",
+                    "in": {"$switch": {
+                        "branches": [
+                            {"case": pending("$$r", rule),
+                             "then": {"$mergeObjects": ["$$r", {
+                                 "status": ResultInRecordStatus.HIT if result else ResultInRecordStatus.DONE,
+                                 "done_time": done_time,
+                                 "result_id": result.id if result else None,
+                             }]}}
+                            for rule, result in outcomes
+                        ],
+                        "default": "$$r"
+                    }}
+                }},
+                "punish.total_punish_level": {"$add": ["$punish.total_punish_level", *[
+                    {"$cond": [is_pending[rule.id], rule.punish_level, 0]} for rule, _ in outcomes]]},
+                "punish.hit_punish_level": {"$add": ["$punish.hit_punish_level", *[
+                    {"$cond": [is_pending[rule.id], rule.punish_level, 0]} for rule, result in outcomes if result]]},
+                "punish.results_done": {"$add": ["$punish.results_done", *[
+                    {"$cond": [is_pending[rule.id], 1, 0]} for rule, _ in outcomes]]},
+            }},
+            *([cls.skip_remaining_stage()] if RULE_EARLY_TERMINATION else []),
+            cls.final_action_stage(),
+        ]
 
     async def auto_punish(self, record: Record) -> None:
         """
@@ -168,7 +555,15 @@ class RuleExecutorConsumer(AmqpConsumer):
             _data = Schema({
                 "record": Use(ObjectId),
                 "rule": Use(ObjectId),
-                "rule_schema": list,
+                SchemaOptional("rule_schema"): list,
+                SchemaOptional("rule_hash"): str,
+            }).validate(data) if 'rules' not in data else Schema({
+                "record": Use(ObjectId),
+                "rules": [{
+                    "rule": Use(ObjectId),
+                    SchemaOptional("rule_schema"): list,
+                    SchemaOptional("rule_hash"): str,
+                }],
             }).validate(data)
         except SchemaError as e:
             self.logger.error(e)
@@ -10,6 +10,7 @@ from config import PROJECT_NAME, RULE_EXE_QUEUE_NAME, RCSExchangeName, PRE_FETCH
     LOG_FILE_RETENTION, LOG_FILE_ROTATION, RUN_PORT
 from utils.fastapi_app import app
 from utils.logger import format_record, InterceptHandler
+from utils.health import router as health_router
 logging.getLogger().handlers = [InterceptHandler()]
 logger.configure(
     handlers=[{"sink": sys.stdout, "level": logging.INFO, "format": format_record}]
@@ -17,10 +18,12 @@ logger.configure(
 logging.getLogger("uvicorn.access").handlers = [InterceptHandler()]
 logger.add(Path(LOG_FILE_PATH) / LOG_FILENAME, retention=LOG_FILE_RETENTION, rotation=LOG_FILE_ROTATION)
 
+app.include_router(health_router, prefix="/api", tags=["health"])
+
 
 @app.on_event("startup")
 async def startup_event():
-    consumer = RuleExecutorConsumer(amqp_connection=app.state.amqp_connection)
+    app.state.consumer = consumer = RuleExecutorConsumer(amqp_connection=app.state.amqp_connection)
     re_consumers, app.state.re_consumer_channels = await make_consumer(
         amqp_connection=app.state.amqp_connection,
         queue_name=RULE_EXE_QUEUE_NAME,
@@ -34,6 +37,9 @@ async def startup_event():
 
 @app.on_event("shutdown")
 async def shutdown_event():
+    # write held results before their messages' channels are closed
+    if app.state.consumer.result_writer:
+        await app.state.consumer.result_writer.close()
     for channel in app.state.re_consumer_channels:
         if not channel.is_closed:
             logger.info(f'Channel closing: {channel}')
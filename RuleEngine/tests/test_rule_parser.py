@@ -3,8 +3,60 @@
 # created: 3/30/21 6:55 PM
 
 from utils.rule_operator import RuleParser
+from utils.rule_compiler import RuleCompiler
 
 
 def test_rule_evaluate():
     ru = ['or', ['>', 1, 2], ['and', ['in_', 1, 1, 2, 3], ['>', 3, ['int', '2']]]]
     assert RuleParser(ru).evaluate() is True
+
+
+def test_rule_compile_evaluate():
+    ru = ['or', ['>', 1, 2], ['and', ['in_', 1, 1, 2, 3], ['>', 3, ['int', '2']]]]
+    compiled = RuleCompiler.compile(ru)
+    assert not compiled.slots
+    assert compiled.evaluate() is RuleParser(ru).evaluate()
+
+
+def test_rule_compile_slots():
+    ru = ['and',
+          ['>', "DATA::Event::60637cd71b57484ca719135e::latest_record::amount", ['int', '2']],
+          ['scene', 'single_withdrawal_amount_limit', ['>', 'scene::amount', 10]]]
+    compiled = RuleCompiler.compile(ru)
+    assert compiled.slots == [(1, 1), (2, )]
+    assert compiled.evaluate(['and', ['>', 3, ['int', '2']], True]) is True
+    assert compiled.evaluate(['and', ['>', 1, ['int', '2']], True]) is False
+    assert compiled.evaluate(['and', ['>', 3, ['int', '2']], False]) is False
+
+
+def test_rule_compile_short_circuit():
+    ru = ['or', ['scene', 'a', ['>', 'scene::amount', 10]], ['scene', 'b', ['>', 'scene::amount', 10]]]
+    compiled = RuleCompiler.compile(ru)
+    # second scene is never read
+    assert compiled.evaluate(['or', True]) is True
+
+
+def test_rule_compile_cheap_branch_first():
+    ru = ['or', ['scene', 'a', ['>', 'scene::amount', 10]], ['=', 'REPL::coin_name', 'USDT']]
+    compiled = RuleCompiler.compile(ru)
+    # scene branch is skipped by lazy rendering
+    assert compiled.evaluate(['or', None, ['=', 'USDT', 'USDT']]) is True
+
+
+
+def test_rule_compile_facet_scene_slots():
+    ru = ['and',
+          ['scene', 'a', ['>', 'scene::amount', 10]],
+          ['or', ['scene', 'b', ['>', 'scene::amount', 10]], ['scene', 'c', ['>', 'scene::amount', 10]]]]
+    compiled = RuleCompiler.compile(ru)
+    # only the first branch of each and/or is always rendered, others keep their short-circuit
+    assert compiled.scene_slots == [0]
+
+
+def test_rule_hash_of_edited_rule():
+    dispatched = ['and', ['>', 'REPL::amount', 100], True]
+    edited = ['and', ['>', 'REPL::amount', 1000], True]
+    assert RuleCompiler.rule_hash(dispatched) != RuleCompiler.rule_hash(edited)
+    # rendered from the dispatched rule, the compiled edited rule must not evaluate it
+    assert RuleParser.evaluate_rule(['and', ['>', 150, 100], True]) is True
+    assert RuleCompiler.compile(edited).evaluate(['and', ['>', 150, 100], True]) is False
@@ -0,0 +1,74 @@
+# @Time : 2026-10-18 22:06:31
+# @Author : Mio Lau
+# @Contact: liurusi.101@gmail.com | github.com/MioYvo
+# @File : agg.py
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import Dict, Iterable, Optional, Tuple
+
+from bson import Decimal128
+from loguru import logger as logging
+
+from SceneScript.register import current_scene
+from config import AGG_DATA_ENABLE, AGG_BUCKET_SECONDS
+from model.odm import Record, AggData, AggCoverage
+from utils import Operator
+from utils.fastapi_app import app
+from utils.window_store import window_store
+
+# filters AggData is keyed by, `user.user_id` is required
+AGG_DIMENSIONS = {'user.user_id', 'user.project', 'event_data.coin_name'}
+
+
+async def agg_window(
+        record: Record,
+        kwargs: Dict[str, Operator],
+        unit_of_time: timedelta,
+        event_data_opt_names: Iterable[str] = (),
+        user_opt_names: Iterable[str] = ()
+) -> Optional[Tuple[int, Decimal]]:
+    """
+    Count and amount sum of the user's records in `unit_of_time`, whole buckets summed from AggData of the rendering
+    scene, the part before the first whole bucket counted from Record as the window store does.
+    :return: (count, amount), None if the scene's filters can't be served by AggData or AggData didn't count
+        records since the start of the window yet
+    """
+    scene_id = current_scene.get()
+    if not AGG_DATA_ENABLE or scene_id is None:
+        return None
+    dims = window_store.scene_dims(record, kwargs, event_data_opt_names, user_opt_names, raw=True)
+    if dims is None or 'user.user_id' not in dims or not set(dims) <= AGG_DIMENSIONS:
+        return None
+    start = datetime.utcnow() - unit_of_time
+    window_start = AggData.bucket_of(start)
+    if window_start < start:
+        # first whole bucket
+        window_start += timedelta(seconds=AGG_BUCKET_SECONDS)
+    since = await AggCoverage.since(scene_id, record.event)
+    if since is None or since > window_start:
+        # an under-count, the scene falls back to aggregate Record
+        return None
+
+    query = {
+        "scene": scene_id,
+        "event": record.event,
+        "user.user_id": dims['user.user_id'],
+        "bucket": {"$gte": window_start},
+    }
+    if 'user.project' in dims:
+        query['user.project'] = dims['user.project']
+    field = 'agg_data'
+    if 'event_data.coin_name' in dims:
+        field = f"agg_data.coins.{AggData.coin_key(dims['event_data.coin_name'])}"
+
+    count, amount = await window_store.exact_window(record, dims, start, min(window_start, datetime.utcnow()))
+    cursor = app.state.engine.get_collection(AggData).find(query, projection={field: 1})
+    async for doc in cursor:
+        data = doc
+        for key in field.split('.'):
+            data = data.get(key) or {}
+        count += data.get('count', 0)
+        _amount = data.get('amount', 0)
+        amount += _amount.to_decimal() if isinstance(_amount, Decimal128) else Decimal(str(_amount))
+    logging.info(f"agg_window:{count=} {amount=}")
+    return count, amount
@@ -3,12 +3,14 @@ from typing import Dict, Iterable, Optional
 
 from loguru import logger as logging
 
+from SceneScript.bases.agg import agg_window
 from SceneScript.parsers import parse_user_opt, parse_event_data_opt
 from config import RULE_ENGINE_USER_DATA_FORMAT
 from model.odm import Record, Event, PredefinedEventName
 from utils import Operator
 from utils.fastapi_app import app
 from utils.gtz import Dt
+from utils.window_store import window_store, ORDER_TO_USERS
 
 
 async def amount_limit(
@@ -47,6 +49,15 @@ async def amount_per_time_limit(
     # <Required> opt
     amount_opt: Operator = kwargs.get('amount')
     unit_of_time: Operator = kwargs.get('unit_of_time')
+    # counters of window store
+    window = await window_store.window(record, kwargs, unit_of_time.data, event_data_opt_names, user_opt_names)
+    if window is None:
+        # pre-aggregated buckets of AggData
+        window = await agg_window(record, kwargs, unit_of_time.data, event_data_opt_names, user_opt_names)
+    if window is not None:
+        _, amount = window
+        logging.info(f"window:{amount=}")
+        return bool(amount_opt.func(Decimal(str(amount)), Decimal(str(amount_opt.data))))
     # <Optional> evnet_data opt
     event_data_queries = parse_event_data_opt(kwargs, record, opt_names=event_data_opt_names)
     # <Optional> user opt
@@ -86,6 +97,15 @@ async def num_per_time_limit(
     # <Required> opt
     number_opt: Operator = kwargs.get('number')
     unit_of_time: Operator = kwargs.get('unit_of_time')
+    # counters of window store
+    window = await window_store.window(record, kwargs, unit_of_time.data, event_data_opt_names, user_opt_names)
+    if window is None:
+        # pre-aggregated buckets of AggData
+        window = await agg_window(record, kwargs, unit_of_time.data, event_data_opt_names, user_opt_names)
+    if window is not None:
+        total_number, _ = window
+        logging.info(f"window:{total_number=}")
+        return bool(number_opt.func(total_number, int(number_opt.data)))
     # <Optional> evnet_data opt
     event_data_queries = parse_event_data_opt(kwargs, record, opt_names=event_data_opt_names)
     # <Optional> user opt
@@ -151,11 +171,21 @@ async def multi_stellar_address_to_one(
         record: Record,
         kwargs: Dict[str, Operator],
         event_data_opt_names: Iterable[str] = ("coin_name", "coin_contract_address", "token_id"),
-        user_opt_names: Iterable[str] = ("user_id", "platform_id", "game_id", "chain_name")
+        user_opt_names: Iterable[str] = ("user_id", "platform_id", "game_id", "chain_name"),
+        max_error: float = 0
 ) -> bool:
+    """
+    :param max_error: relative error of the distinct user count accepted, counted by HyperLogLog if it's enough
+    """
     # <Required> opt
     number_opt: Operator = kwargs.get('number')
     unit_of_time: Operator = kwargs.get('unit_of_time')
+    estimate = await window_store.distinct(
+        record, kwargs, unit_of_time.data, sketch=ORDER_TO_USERS, threshold=int(number_opt.data),
+        max_error=max_error, event_data_opt_names=event_data_opt_names, user_opt_names=user_opt_names
+    )
+    if estimate is not None:
+        return bool(number_opt.func(estimate, int(number_opt.data)))
     # <Optional> evnet_data opt
     event_data_queries = parse_event_data_opt(kwargs, record, opt_names=event_data_opt_names)
     # <Optional> user opt
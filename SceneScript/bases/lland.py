@@ -12,12 +12,14 @@ from model.odm import Record
 from utils import Operator
 from utils.gtz import Dt
 from utils.fastapi_app import app
+from utils.window_store import window_store, USER_CONTRACTS
 
 
 async def contract_addr_num_per_time_limit(
         record: Record, kwargs: Dict[str, Operator],
         event_data_opt_names: Iterable[str] = ("coin_contract_address", "token_id"),
-        user_opt_names: Iterable[str] = ("user_id", "platform_id", "game_id", "chain_name")
+        user_opt_names: Iterable[str] = ("user_id", "platform_id", "game_id", "chain_name"),
+        max_error: float = 0
 ) -> bool:
     """
     单位时间内提卡数量限制
@@ -25,10 +27,17 @@ async def contract_addr_num_per_time_limit(
     :param event_data_opt_names: Tuple[str]
     :param record:
     :param kwargs:
+    :param max_error: relative error of the contract address count accepted, counted by HyperLogLog if it's enough
     :return:
     """
     number_opt: Operator = kwargs.get('number')
     unit_of_time: Operator = kwargs.get('unit_of_time')
+    estimate = await window_store.distinct(
+        record, kwargs, unit_of_time.data, sketch=USER_CONTRACTS, threshold=int(number_opt.data),
+        max_error=max_error, event_data_opt_names=event_data_opt_names, user_opt_names=user_opt_names
+    )
+    if estimate is not None:
+        return bool(number_opt.func(estimate, int(number_opt.data)))
     # event_data <Optional> opt
     event_data_queries = parse_event_data_opt(
         kwargs, record, opt_names=event_data_opt_names)
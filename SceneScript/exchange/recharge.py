@@ -3,6 +3,7 @@ Exchange(充提币) Recharge(充币) 场景脚本
 """
 from typing import Dict
 
+from config import DISTINCT_MAX_ERROR
 from utils import Operator
 from model.odm import Record
 from SceneScript.register import scripts_manager
@@ -11,7 +12,7 @@ from SceneScript.bases.exchange import (
 )
 
 
-@scripts_manager.register
+@scripts_manager.register(cost=1)
 async def exchange_recharge_amount_limit(record: Record, kwargs: Dict[str, Operator]) -> bool:
     return await amount_limit(
         record=record, kwargs=kwargs,
@@ -40,5 +41,6 @@ async def exchange_recharge_num_per_time_limit(record: Record, kwargs: Dict[str,
 async def exchange_recharge_multi_stellar_address_to_one(record: Record, kwargs: Dict[str, Operator]) -> bool:
     return await multi_stellar_address_to_one(
         record=record, kwargs=kwargs,
-        event_data_opt_names=(), user_opt_names=("user_id", "project")
+        event_data_opt_names=(), user_opt_names=("user_id", "project"),
+        max_error=DISTINCT_MAX_ERROR,
     )
@@ -1,5 +1,6 @@
 from typing import Dict
 
+from config import DISTINCT_MAX_ERROR
 from utils import Operator
 from model.odm import Record
 from SceneScript import scripts_manager
@@ -16,7 +17,7 @@ async def exchange_withdraw_without_recharge(record: Record, kwargs: Dict[str, O
     )
 
 
-@scripts_manager.register
+@scripts_manager.register(cost=1)
 async def exchange_withdrawal_amount_limit(record: Record, kwargs: Dict[str, Operator]) -> bool:
     return await amount_limit(
         record=record, kwargs=kwargs,
@@ -45,5 +46,6 @@ async def exchange_withdrawal_num_per_time_limit(record: Record, kwargs: Dict[st
 async def exchange_multi_stellar_address_withdraw_to_one(record: Record, kwargs: Dict[str, Operator]) -> bool:
     return await multi_stellar_address_to_one(
         record=record, kwargs=kwargs,
-        event_data_opt_names=(), user_opt_names=("user_id", "project")
+        event_data_opt_names=(), user_opt_names=("user_id", "project"),
+        max_error=DISTINCT_MAX_ERROR,
     )
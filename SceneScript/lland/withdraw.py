@@ -4,6 +4,7 @@
 # @File : withdraw.py
 from typing import Dict
 
+from config import DISTINCT_MAX_ERROR
 from utils import Operator
 from model.odm import Record
 from SceneScript import scripts_manager
@@ -13,7 +14,7 @@ from SceneScript.bases.exchange import (
     amount_limit, withdraw_without_recharge, multi_stellar_address_to_one)
 
 
-@scripts_manager.register
+@scripts_manager.register(cost=1)
 async def lland_withdrawal_amount_limit(record: Record, kwargs: Dict[str, Operator]) -> bool:
     return await amount_limit(
         record=record, kwargs=kwargs,
@@ -57,6 +58,7 @@ async def lland_multi_address_withdraw_to_one(
         record=record, kwargs=kwargs,
         event_data_opt_names=("coin_contract_address", "token_id"),
         user_opt_names=("user_id", "project", "platform_id", "game_id", "chain_name"),
+        max_error=DISTINCT_MAX_ERROR,
     )
 
 
@@ -73,4 +75,5 @@ async def lland_withdrawal_contract_addr_num_per_time_limit(
         record=record, kwargs=kwargs,
         event_data_opt_names=("coin_name", "token_id"),
         user_opt_names=("user_id", "project", "platform_id", "game_id", "chain_name"),
+        max_error=DISTINCT_MAX_ERROR,
     )
@@ -1,4 +1,8 @@
 import functools
+from contextvars import ContextVar
+from typing import Optional
+
+from bson import ObjectId
 # scene_scripts = dict()
 #
 #
@@ -12,18 +16,36 @@ import functools
 #     return wrapper
 
 
+# relative cost of running a scene script, cheap scenes are evaluated first in `and`/`or` rules.
+# default one is a MongoDB aggregation
+DEFAULT_SCENE_COST = 10
+
+# id of the Scene being rendered, set by `RuleParser._render_scene` for scene scripts reading AggData
+current_scene: ContextVar[Optional[ObjectId]] = ContextVar('current_scene', default=None)
+
+
 class ScriptsManager:
     def __init__(self):
         self.scene_scripts = {}
+        self.scene_costs = {}
 
-    def register(self, func):
+    def register(self, func=None, *, cost: int = DEFAULT_SCENE_COST):
+        """
+        Usage: `@scripts_manager.register`, `@scripts_manager.register(cost=1)` or `scripts_manager.register(func)`
+        """
+        if func is None:
+            return functools.partial(self.register, cost=cost)
         if not self.scene_scripts.get(func.__name__):
             self.scene_scripts[func.__name__] = func
+            self.scene_costs[func.__name__] = cost
 
         @functools.wraps(func)
         def wrapper(*args, **kw):
             return func(*args, **kw)
         return wrapper
 
+    def cost(self, scene_name: str) -> int:
+        return self.scene_costs.get(scene_name, DEFAULT_SCENE_COST)
+
 
 scripts_manager = ScriptsManager()
@@ -19,6 +19,8 @@ RULE_EXE_ROUTING_KEY = getenv('RULE_EXE_ROUTING_KEY', 'RuleEngineExe')
 RUN_HOST = getenv("RUN_HOST", "traefik")
 RUN_PORT = int(getenv("RUN_PORT", 80))   # must be 80
 CACHE_NAMESPACE = getenv('CACHE_NAMESPACE', 'RCS')
+# bump to drop all cached instances, keys are also versioned by the fields of their model
+CACHE_VERSION = getenv('CACHE_VERSION', '1')
 DOCS_URL = getenv('DOCS_URL', '/docs')
 OPENAPI_URL = getenv('OPENAPI_URL', '/openapi.json')
 REDOC_URL = getenv('REDOC_URL', '/redoc')
@@ -41,6 +43,42 @@ PRE_FETCH_COUNT = int(getenv('PRE_FETCH_COUNT', 10))
 DATA_PROCESSOR_QUEUE_NAME = getenv('DATA_PROCESSOR_QUEUE_NAME', 'DataProcessor')
 RULE_EXE_QUEUE_NAME = getenv('RULE_EXE_QUEUE_NAME', 'RuleEngineExe')
 
+# Window store, bucketed counters in redis for *_per_time_limit scenes, see `utils.window_store`
+WINDOW_STORE_ENABLE = bool(int(getenv('WINDOW_STORE_ENABLE', 0)))
+WINDOW_BUCKET_SECONDS = int(getenv('WINDOW_BUCKET_SECONDS', 60))
+WINDOW_MAX_SECONDS = int(getenv('WINDOW_MAX_SECONDS', 7 * 24 * 3600))   # longest unit_of_time of scenes
+# dimension sets counters are keyed by, "dim1,dim2;dim1,dim2,dim3"
+WINDOW_DIMENSIONS = [
+    frozenset(filter(None, map(str.strip, dims.split(','))))
+    for dims in getenv(
+        'WINDOW_DIMENSIONS', 'user.user_id,user.project;user.user_id,user.project,event_data.coin_name'
+    ).split(';') if dims.strip()
+]
+# distinct counts by redis HyperLogLog, keyed by the sketch's own dimension plus none or one of DISTINCT_DIMENSIONS
+DISTINCT_BUCKET_SECONDS = int(getenv('DISTINCT_BUCKET_SECONDS', 600))
+DISTINCT_DIMENSIONS = [
+    frozenset(filter(None, map(str.strip, dims.split(','))))
+    for dims in getenv('DISTINCT_DIMENSIONS', 'user.project').split(';') if dims.strip()
+]
+# relative error of distinct counts scenes accept, 0 to always count exactly in MongoDB
+DISTINCT_MAX_ERROR = float(getenv('DISTINCT_MAX_ERROR', 0.02))
+# AggData, per scene and user count/amount of records in time buckets, see `model.odm.AggData`
+AGG_DATA_ENABLE = bool(int(getenv('AGG_DATA_ENABLE', 0)))
+AGG_BUCKET_SECONDS = int(getenv('AGG_BUCKET_SECONDS', 3600))
+
+# in-process L1 cache in front of the redis instance cache, see `utils.cache.LocalCache`
+CACHE_L1_ENABLE = bool(int(getenv('CACHE_L1_ENABLE', 1)))
+CACHE_L1_TTL = int(getenv('CACHE_L1_TTL', 60))     # bounds staleness if an invalidation message is lost
+CACHE_L1_SIZE = int(getenv('CACHE_L1_SIZE', 1024))  # per model
+CACHE_NEGATIVE_TTL = int(getenv('CACHE_NEGATIVE_TTL', 5))  # seconds to remember missing documents, 0 to disable
+# serializer of the redis instance cache: json or bson, see `utils.encoder.BsonSerializer`
+CACHE_SERIALIZER = getenv('CACHE_SERIALIZER', 'json')
+CACHE_COMPRESSION = getenv('CACHE_COMPRESSION', 'zlib')  # bson only: zlib, lz4 (if installed) or empty
+CACHE_COMPRESS_MIN_SIZE = int(getenv('CACHE_COMPRESS_MIN_SIZE', 1024))  # bytes
+# load ON rules, events, scenes and configs into the caches before consumers start, see `utils.warmup`
+CACHE_WARM_UP = bool(int(getenv('CACHE_WARM_UP', 1)))
+CACHE_INVALIDATION_CHANNEL = getenv('CACHE_INVALIDATION_CHANNEL', f'{CACHE_NAMESPACE}:CacheInvalidation')
+
 # MongoDB
 MONGO_HOST = getenv('MONGO_HOST', 'localhost')
 MONGO_PORT = int(getenv('MONGO_PORT', 27017))
@@ -62,6 +100,9 @@ MONGO_URI = URL.build(scheme='mongodb', host=MONGO_HOST, port=MONGO_PORT, user=M
                           MAXPoolSize=MONGO_MAXPoolSize,
                           retryWrites='false'     # FOR amazon documentDB
                       ))
+# updates with an aggregation pipeline ($switch, $map, ... in MongoDB 4.2+), off by default as amazon documentDB
+# doesn't fully support them, enable only where the server is confirmed to
+MONGO_PIPELINE_UPDATE = bool(int(getenv('MONGO_PIPELINE_UPDATE', 0)))
 
 
 # MariaDB
@@ -138,6 +179,8 @@ PIKA_URL = URL.build(
     password=PIKA_PASS
 )
 PIKA_MANAGEMENT_PORT = int(getenv('PIKA_MANAGEMENT_PORT', 15672))
+# confirm-mode channels kept open by `utils.amqp_publisher.AmqpPublisher`
+PIKA_PUBLISHER_CHANNELS = int(getenv('PIKA_PUBLISHER_CHANNELS', 4))
 # pika_api = AdminAPI(url=f'http://{PIKA_HOST}:{PIKA_MANAGEMENT_PORT}', auth=(PIKA_USER, PIKA_PASS))
 # rabbit_api = Client(api_url=f'{PIKA_HOST}:{PIKA_MANAGEMENT_PORT}', user=PIKA_USER, passwd=PIKA_PASS)
 
@@ -166,6 +209,33 @@ CONSUL_SERVICE_ID = getenv('CONSUL_SERVICE_ID', 'rcs_1')
 
 # Rule Engine
 RULE_ENGINE_USER_DATA_FORMAT = getenv('SPECIAL_USER_DATA_FORMAT', '<<USER_DATA>>')
+# only render scenes and `DATA::` args needed by and/or, see `utils.rule_compiler.CompiledRule.render`
+RULE_LAZY_RENDER = bool(int(getenv('RULE_LAZY_RENDER', 1)))
+# render the scenes every evaluation of a rule reads at once, their aggregations merged into one $facet, scenes
+# behind an and/or short-circuit are still rendered lazily, see `utils.query_planner`
+RULE_SCENE_FACET = bool(int(getenv('RULE_SCENE_FACET', 0)))
+# DataProcessor publishes only record and rule ids, RuleEngine workers render and evaluate the rule
+RULE_RENDER_IN_EXECUTOR = bool(int(getenv('RULE_RENDER_IN_EXECUTOR', 0)))
+# one message per record with all its rules, evaluated by RULE_EXE_CONCURRENCY coroutines and written at once
+RULE_DISPATCH_ENVELOPE = bool(int(getenv('RULE_DISPATCH_ENVELOPE', 0)))
+RULE_EXE_CONCURRENCY = int(getenv('RULE_EXE_CONCURRENCY', 8))
+# skip remaining rules of a record once its hit punish level reaches the top action
+RULE_EARLY_TERMINATION = bool(int(getenv('RULE_EARLY_TERMINATION', 1)))
+# dispatch by the (event, project) -> rules snapshot, see `utils.ruleset`
+RULESET_SNAPSHOT_ENABLE = bool(int(getenv('RULESET_SNAPSHOT_ENABLE', 1)))
+RULESET_SNAPSHOT_TTL = int(getenv('RULESET_SNAPSHOT_TTL', 300))
+# RuleEngine writes results of concurrent messages in batches, acks are held until the batch is written.
+# Batches are bounded by PRE_FETCH_COUNT, raise it with the batch size. Without MONGO_PIPELINE_UPDATE a batch is one
+# positional update per result in one bulk_write, followed by a read back of the records to set their punish action.
+RULE_EXE_BATCH_ENABLE = bool(int(getenv('RULE_EXE_BATCH_ENABLE', 1)))
+RULE_EXE_BATCH_SIZE = int(getenv('RULE_EXE_BATCH_SIZE', 500))
+RULE_EXE_BATCH_DELAY = float(getenv('RULE_EXE_BATCH_DELAY_MS', 5)) / 1000
+# DataProcessor inserts records of concurrent messages with one insert_many, bounded by PRE_FETCH_COUNT as well
+DATA_PROCESSOR_BATCH_ENABLE = bool(int(getenv('DATA_PROCESSOR_BATCH_ENABLE', 1)))
+DATA_PROCESSOR_BATCH_SIZE = int(getenv('DATA_PROCESSOR_BATCH_SIZE', 200))
+DATA_PROCESSOR_BATCH_DELAY = float(getenv('DATA_PROCESSOR_BATCH_DELAY_MS', 5)) / 1000
+# rules of a record rendered concurrently by DataProcessor
+DATA_PROCESSOR_DISPATCH_CONCURRENCY = int(getenv('DATA_PROCESSOR_DISPATCH_CONCURRENCY', 8))
 
 callback_service_config = {
     "VDEX": {"service_name": "vdex_dapp_phpservice"},
@@ -11,8 +11,10 @@ from motor.motor_asyncio import AsyncIOMotorClient
 from redis import Redis
 
 from config import MONGO_URI, REDIS_HOST, REDIS_PORT, REDIS_DB, REDIS_PASS, MONGO_DB, \
-    MONGO_COLLECTION_EVENT, MONGO_COLLECTION_RECORD, MONGO_COLLECTION_RULE, CACHE_NAMESPACE, CONSUL_CONN, SCHEMA_TTL
+    MONGO_COLLECTION_EVENT, MONGO_COLLECTION_RECORD, MONGO_COLLECTION_RULE, CACHE_NAMESPACE, CONSUL_CONN, SCHEMA_TTL, \
+    CACHE_SERIALIZER, CACHE_COMPRESSION, CACHE_COMPRESS_MIN_SIZE
 from config.parser import parse_consul_config, key_builder_only_kwargs
+from utils.cache import model_cache_version
 from utils.logger import Logger
 from utils.u_consul import Consul
 
@@ -59,6 +61,12 @@ redis_cache_only_kwargs_conf = dict(
 # redis_cache_only_kwargs = Cache(**redis_cache_only_kwargs_conf)
 # redis_cache_no_self = Cache(**redis_cache_no_self_conf)
 
+cache_serializers = {
+    'json': {'class': "utils.encoder.JsonSerializer"},
+    'bson': {'class': "utils.encoder.BsonSerializer",
+             'compression': CACHE_COMPRESSION, 'compress_min_size': CACHE_COMPRESS_MIN_SIZE},
+}
+
 caches.set_config({
     'default': dict(
         cache=Cache.REDIS, endpoint=REDIS_HOST, port=REDIS_PORT,
@@ -68,7 +76,8 @@ caches.set_config({
             {'class': "aiocache.plugins.HitMissRatioPlugin"},
             {'class': "aiocache.plugins.TimingPlugin"}
         ],
-        serializer={'class': "utils.encoder.JsonSerializer"},
+        # instance cache of YvoEngine
+        serializer=cache_serializers[CACHE_SERIALIZER],
     ),
     'redis_cache_no_self_conf': dict(
         cache=Cache.REDIS, endpoint=REDIS_HOST, port=REDIS_PORT,
@@ -97,7 +106,11 @@ caches.set_config({
 
 def key_builder(_, *__, **kwargs):
     # DPC: Document Primary key Cache
-    return f"DPC:{kwargs['model'].__name__}:{kwargs['primary_key']}"
+    return instance_cache_key(kwargs['model'].__name__, model_cache_version(kwargs['model']), kwargs['primary_key'])
+
+
+def instance_cache_key(model_name: str, version: str, primary_key) -> str:
+    return f"DPC:{model_name}:{version}:{primary_key}"
 
 
 cached_instance = cached(ttl=SCHEMA_TTL, alias='default', noself=True, key_builder=key_builder)
@@ -2,6 +2,7 @@
 # __email__: "liurusi.101@gmail.com"
 # created: 5/12/21 6:27 PM
 import datetime
+import hashlib
 from decimal import Decimal
 from enum import Enum
 from functools import reduce
@@ -10,10 +11,12 @@ from typing import List, Optional, Union, Set, Dict
 from bson import Decimal128
 from odmantic.bson import BSON_TYPES_ENCODERS
 from pydantic import validator, root_validator
-from pymongo import IndexModel
+from pymongo import IndexModel, UpdateOne
 from odmantic import Model, ObjectId, Field, EmbeddedModel
 from pymongo.results import DeleteResult
 
+from config import AGG_BUCKET_SECONDS
+from utils.cache import CachePolicy, NO_CACHE_POLICY
 from utils.exceptions import RCSExcErrArg
 from utils.event_schema import EventSchema
 from utils.gtz import Dt
@@ -45,6 +48,7 @@ class ResultInRecordStatus(str, Enum):
     DISPATCHED = "dispatched"
     DONE = "done"
     HIT = "hit"
+    SKIPPED = "skipped"  # not evaluated, the record reached MAX_PUNISH_LEVEL
 
 
 class Status(str, Enum):
@@ -92,6 +96,8 @@ PUNISH_ACTION_LEVEL_MAP = {
     15: Action.BAN_USER_LOGIN,
     50: Action.BLOCK_USER
 }
+# no more rules can change the action of a record reaching this level
+MAX_PUNISH_LEVEL = max(PUNISH_ACTION_LEVEL_MAP)
 
 
 def suggest_final_punishment(done_punish_level: int) -> str:
@@ -104,6 +110,21 @@ def suggest_final_punishment(done_punish_level: int) -> str:
     return final_punish_action
 
 
+def suggest_final_punishment_expression(done_punish_level: str, default) -> dict:
+    """
+    `suggest_final_punishment` as an aggregation expression, for pipeline updates
+    :param done_punish_level: expression of the punish level, e.g. "$punish.hit_punish_level"
+    :param default: expression if no action suggested
+    """
+    return {"$switch": {
+        "branches": [
+            {"case": {"$gte": [done_punish_level, _level]}, "then": action.value}
+            for _level, action in sorted(PUNISH_ACTION_LEVEL_MAP.items(), reverse=True)
+        ],
+        "default": default
+    }}
+
+
 # noinspection PyAbstractClass
 class Event(Model):
     rcs_schema: dict = Field(..., title="事件参数定义")
@@ -124,7 +145,7 @@ class Event(Model):
     @validator("rcs_schema")
     def check_rcs_schema(cls, v) -> dict:
         try:
-            EventSchema.parse(v)
+            EventSchema.compile(v)
         except Exception as e:
             logger.error(e)
             raise RCSExcErrArg(content=f"EventSchema parse failed {e}")
@@ -188,6 +209,9 @@ class PunishInRecord(EmbeddedModel):
     results_done: int = Field(default=0, title="已完成检查的规则数量")
     action: Action = Field(default=Action.NOTHING, title="惩罚动作")
 
+    def reached_max(self) -> bool:
+        return self.hit_punish_level >= MAX_PUNISH_LEVEL
+
     def log_status(self):
         return f"{self.hit_punish_level}/{self.total_punish_level} - {self.action.name} - done:{self.results_done}"
 
@@ -212,6 +236,11 @@ class Record(Model):
             IndexModel('event_data.order_no', unique=True, name='idx_event_data_order_no_1', sparse=True)
         ]
 
+    @classmethod
+    def cache_policy_(cls) -> CachePolicy:
+        # written by every rule result, cached copies are invalidated before they are read again
+        return NO_CACHE_POLICY
+
     async def event_(self) -> Optional[Event]:
         return await app.state.engine.get_by_id(Event, self.event)
 
@@ -295,7 +324,10 @@ class Handler(Model):
 
     @classmethod
     def index_(cls):
-        return [IndexModel('name', unique=True, name='idx_name_1')]
+        return [
+            IndexModel('name', unique=True, name='idx_name_1'),
+            IndexModel('token', unique=True, name='idx_token_1'),
+        ]
 
 
 class Punishment(Model):
@@ -363,7 +395,7 @@ class Scene(Model):
     @validator("scene_schema")
     def check_scene_schema(cls, v) -> dict:
         try:
-            EventSchema.parse(v)
+            EventSchema.compile(v)
         except Exception as e:
             logger.exceptions(e)
             raise RCSExcErrArg(content="SceneSchema parse failed")
@@ -394,13 +426,120 @@ class Scene(Model):
 
 # noinspection PyAbstractClass
 class AggData(Model):
+    """
+    Count and amount sum of one user's records of `event` in one time bucket, for every scene referring the event.
+    Maintained by DataProcessor with `$inc` upserts, so window scenes sum a few buckets instead of scanning Record.
+        agg_data: {"count": 3, "amount": Decimal128("12.5"), "coins": {"USDT": {"count": 2, "amount": ...}}}
+    """
     scene: ObjectId
+    event: ObjectId
     user: User
+    bucket: datetime.datetime = Field(..., title="时间桶起始时间(UTC)")
     agg_data: dict
-    
+    update_at: Optional[datetime.datetime] = Field(default_factory=datetime.datetime.utcnow)
+
     class Config:
         json_encoders = {Decimal: str, **BSON_TYPES_ENCODERS}
 
+    @classmethod
+    def index_(cls):
+        return [
+            IndexModel([('scene', 1), ('event', 1), ('user.user_id', 1), ('user.project', 1), ('bucket', 1)],
+                       unique=True, name='idx_scene_1_event_1_user_id_1_project_1_bucket_1')
+        ]
+
+    @staticmethod
+    def bucket_of(dt: datetime.datetime, bucket_seconds: int = AGG_BUCKET_SECONDS) -> datetime.datetime:
+        if dt.tzinfo:
+            ts = dt.timestamp()
+        else:
+            ts = dt.replace(tzinfo=datetime.timezone.utc).timestamp()
+        return datetime.datetime.utcfromtimestamp(ts // bucket_seconds * bucket_seconds)
+
+    @staticmethod
+    def coin_key(coin_name) -> str:
+        # field names can't contain "." or start with "$"
+        return str(coin_name).replace('.', '_').replace('$', '_')
+
+    @classmethod
+    async def incr(cls, record: Record, scenes: Optional[List[ObjectId]] = None):
+        """
+        Count a saved record in the buckets of all scenes referring its event
+        :param record:
+        :param scenes: ids of scenes referring `record.event`, queried if not given
+        """
+        if scenes is None:
+            # noinspection PyUnresolvedReferences
+            scenes = [scene.id for scene in await app.state.engine.find(Scene, Scene.events.in_([record.event]))]
+        if not scenes:
+            return
+
+        amount = Decimal128(str(record.event_data.get('amount') or 0))
+        inc = {"agg_data.count": 1, "agg_data.amount": amount}
+        coin_name = record.event_data.get('coin_name')
+        if coin_name is not None:
+            coin_key = cls.coin_key(coin_name)
+            inc[f"agg_data.coins.{coin_key}.count"] = 1
+            inc[f"agg_data.coins.{coin_key}.amount"] = amount
+        bucket = cls.bucket_of(record.create_at)
+        update_at = datetime.datetime.utcnow()
+        await app.state.engine.get_collection(cls).bulk_write([
+            UpdateOne(
+                {"scene": scene_id, "event": record.event, "user.user_id": record.user.user_id,
+                 "user.project": record.user.project, "bucket": bucket},
+                {"$inc": inc, "$set": {"update_at": update_at}, "$setOnInsert": {"user": record.user.doc()}},
+                upsert=True
+            ) for scene_id in scenes
+        ], ordered=False)
+        await AggCoverage.start(scenes, record)
+
+
+# (scene, event) -> `AggCoverage.since` known by this process, `since` only moves backwards, so a known coverage
+# stays valid
+_agg_coverage: Dict[tuple, datetime.datetime] = {}
+
+
+# noinspection PyAbstractClass
+class AggCoverage(Model):
+    """
+    Since when AggData of a scene and event counts records, written by the first `AggData.incr`.
+    Windows starting earlier, e.g. before AGG_DATA_ENABLE or before the scene referred the event, are not
+    covered by AggData.
+    """
+    scene: ObjectId
+    event: ObjectId
+    since: datetime.datetime = Field(..., title="首条计入记录的创建时间(UTC)")
+
+    @classmethod
+    def index_(cls):
+        return [
+            IndexModel([('scene', 1), ('event', 1)], unique=True, name='idx_scene_1_event_1')
+        ]
+
+    @classmethod
+    async def start(cls, scenes: List[ObjectId], record: Record):
+        scenes = [scene_id for scene_id in scenes if (scene_id, record.event) not in _agg_coverage]
+        if not scenes:
+            return
+        await app.state.engine.get_collection(cls).bulk_write([
+            UpdateOne({"scene": scene_id, "event": record.event}, {"$min": {"since": record.create_at}}, upsert=True)
+            for scene_id in scenes
+        ], ordered=False)
+        for scene_id in scenes:
+            _agg_coverage[(scene_id, record.event)] = record.create_at
+
+    @classmethod
+    async def since(cls, scene: ObjectId, event: ObjectId) -> Optional[datetime.datetime]:
+        """
+        :return: None if AggData of the scene and event hasn't counted any record yet
+        """
+        since = _agg_coverage.get((scene, event))
+        if since is None:
+            doc = await app.state.engine.get_collection(cls).find_one({"scene": scene, "event": event})
+            if doc:
+                since = _agg_coverage[(scene, event)] = doc['since']
+        return since
+
 
 # noinspection PyAbstractClass
 class Config(Model):
@@ -588,7 +727,18 @@ class Result(Model):
 
     @classmethod
     def index_(cls):
-        return []
+        return [
+            # one Result per rule of a record, see `RuleExecutorConsumer.insert_results`
+            IndexModel([('record', 1), ('rule', 1)], unique=True, name='idx_record_1_rule_1'),
+        ]
+
+    @staticmethod
+    def id_of(record: ObjectId, rule: ObjectId) -> ObjectId:
+        """
+        Deterministic `_id` of the Result of a rule of a record, so a redelivered message refers to the Result
+        upserted by the first delivery. Keeps the timestamp of the record id, the rest is a hash of both ids.
+        """
+        return ObjectId(record.binary[:4] + hashlib.sha1(record.binary + rule.binary).digest()[:8])
 
     async def rule_(self) -> Rule:
         return await app.state.engine.get_by_id(Rule, self.rule)
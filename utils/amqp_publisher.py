@@ -1,40 +1,127 @@
+import asyncio
+import itertools
 import json
 import logging
+from typing import Dict, List, Optional, Set, Tuple
+from weakref import WeakKeyDictionary
 
-from aio_pika import Connection, Message
+from aio_pika import Channel, Connection, Exchange, Message
 from pamqp.specification import Basic
 
+from config import PIKA_PUBLISHER_CHANNELS
 from utils.encoder import MyEncoder
 
+PublishResult = Tuple[bool, object, dict]
+
+
+class AmqpPublisher:
+    """
+    Long-lived publisher of one connection.
+    Keeps a pool of confirm-mode channels and their exchanges, messages are spread over the channels round-robin.
+    Confirms are tracked by aio-pika per delivery tag, so concurrent publishes on one channel are pipelined:
+    `publish_nowait` returns at once and `flush` waits for all outstanding confirms.
+    """
+    _publishers: 'WeakKeyDictionary[Connection, AmqpPublisher]' = WeakKeyDictionary()
+
+    def __init__(self, conn: Connection, pool_size: int = PIKA_PUBLISHER_CHANNELS):
+        self.conn = conn
+        self.pool_size = max(pool_size, 1)
+        self._channels: List[Optional[Channel]] = [None] * self.pool_size
+        self._exchanges: Dict[Tuple[int, str], Exchange] = {}
+        self._round_robin = itertools.cycle(range(self.pool_size))
+        self._lock = asyncio.Lock()
+        self._pending: Set[asyncio.Future] = set()
+
+    @classmethod
+    def of(cls, conn: Connection) -> 'AmqpPublisher':
+        """
+        Publisher shared by all users of `conn`
+        """
+        _publisher = cls._publishers.get(conn)
+        if _publisher is None:
+            _publisher = cls._publishers[conn] = cls(conn)
+        return _publisher
+
+    async def _channel(self) -> Tuple[int, Channel]:
+        index = next(self._round_robin)
+        channel = self._channels[index]
+        if channel is None or channel.is_closed:
+            async with self._lock:
+                channel = self._channels[index]
+                if channel is None or channel.is_closed:
+                    channel = self._channels[index] = await self.conn.channel(publisher_confirms=True)
+                    self._exchanges = {k: v for k, v in self._exchanges.items() if k[0] != index}
+        return index, channel
+
+    async def _exchange(self, exchange_name: str) -> Exchange:
+        index, channel = await self._channel()
+        exchange = self._exchanges.get((index, exchange_name))
+        if exchange is None:
+            exchange = self._exchanges[(index, exchange_name)] = await channel.get_exchange(exchange_name)
+        return exchange
+
+    async def publish(self, message: dict, exchange_name: str, routing_key: str = "",
+                      **message_kwargs) -> PublishResult:
+        """
+        Publish and wait for the broker's confirm
+        :return: (published, ack or exception, message)
+        """
+        try:
+            exchange = await self._exchange(exchange_name)
+            rst = await exchange.publish(
+                message=Message(
+                    body=bytes(json.dumps(message, cls=MyEncoder), 'utf-8'),
+                    **message_kwargs
+                ),
+                routing_key=routing_key
+            )
+        except Exception as e:
+            logging.error(e)
+            logging.error(
+                f"Published Failed exchange:{exchange_name} routing_key:{routing_key} : {message.get('type')} "
+                f"-> {message}")
+            return False, e, message
+        else:
+            if isinstance(rst, Basic.Ack):
+                # normal got ack
+                return True, rst, message
+            else:
+                logging.error(
+                    f"Published&Delivered exchange:{exchange_name} routing_key:{routing_key} :"
+                    f" {rst} -> {message}")
+                return False, rst, message
+
+    def publish_nowait(self, message: dict, exchange_name: str, routing_key: str = "",
+                       **message_kwargs) -> 'asyncio.Future[PublishResult]':
+        """
+        Publish without waiting for the confirm, await the returned future or `flush` for the result
+        """
+        future = asyncio.ensure_future(self.publish(message, exchange_name, routing_key, **message_kwargs))
+        self._pending.add(future)
+        future.add_done_callback(self._pending.discard)
+        return future
+
+    async def flush(self) -> List[PublishResult]:
+        """
+        Wait for confirms of all messages published by `publish_nowait`
+        """
+        if not self._pending:
+            return []
+        return await asyncio.gather(*list(self._pending))
+
+    async def close(self):
+        await self.flush()
+        for channel in self._channels:
+            if channel is not None and not channel.is_closed:
+                await channel.close()
+        self._channels = [None] * self.pool_size
+        self._exchanges.clear()
+        self._publishers.pop(self.conn, None)
+
 
 async def publisher(conn: Connection,
                     message: dict,
                     exchange_name: str,
                     routing_key: str = "",
-                    **message_kwargs,):
-    channel = await conn.channel()
-    try:
-        exchange = await channel.get_exchange(exchange_name)
-        rst = await exchange.publish(
-            message=Message(
-                body=bytes(json.dumps(message, cls=MyEncoder), 'utf-8'),
-                **message_kwargs
-            ),
-            routing_key=routing_key
-        )
-    except Exception as e:
-        logging.error(e)
-        logging.error(
-            f"Published Failed exchange:{exchange_name} routing_key:{routing_key} : {message['type']} -> {message}")
-        return False, e, message
-    else:
-        if isinstance(rst, Basic.Ack):
-            # normal got ack
-            return True, rst, message
-        else:
-            logging.error(
-                f"Published&Delivered exchange:{exchange_name} routing_key:{routing_key} :"
-                f" {rst} -> {message}")
-            return False, rst, message
-    finally:
-        await channel.close()
+                    **message_kwargs,) -> PublishResult:
+    return await AmqpPublisher.of(conn).publish(message, exchange_name, routing_key, **message_kwargs)
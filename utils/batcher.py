@@ -0,0 +1,74 @@
+# @Time : 2026-10-18 23:21:47
+# @Author : Mio Lau
+# @Contact: liurusi.101@gmail.com | github.com/MioYvo
+# @File : batcher.py
+import asyncio
+from typing import Awaitable, Callable, Generic, List, Optional, Sequence, Set, Tuple, TypeVar, Union
+
+from utils.logger import Logger
+
+T = TypeVar('T')
+R = TypeVar('R')
+# results of a flush, one per item in order, an exception fails only its item
+FlushResults = Sequence[Union[R, BaseException]]
+
+
+class MicroBatcher(Generic[T, R]):
+    """
+    Collects items submitted by concurrent coroutines and flushes them together, after `max_delay` seconds from the
+    first item or as soon as there are `max_size` items.
+    `submit` returns after the item's batch is flushed, so callers can hold acks until their writes are durable.
+    """
+    logger = Logger(name='MicroBatcher')
+
+    def __init__(self, flush: Callable[[List[T]], Awaitable[FlushResults]],
+                 max_size: int = 500, max_delay: float = 0.005, name: str = ''):
+        self._flush = flush
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.name = name or getattr(flush, '__qualname__', '')
+        self._items: List[Tuple[T, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._flushing: Set[asyncio.Task] = set()
+
+    async def submit(self, item: T) -> R:
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._items.append((item, future))
+        if len(self._items) >= self.max_size:
+            self._flush_now()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_delay, self._flush_now)
+        return await future
+
+    def _flush_now(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        items, self._items = self._items, []
+        if items:
+            task = asyncio.ensure_future(self._run(items))
+            self._flushing.add(task)
+            task.add_done_callback(self._flushing.discard)
+
+    async def _run(self, items: List[Tuple[T, asyncio.Future]]):
+        try:
+            results = await self._flush([item for item, _ in items])
+        except Exception as e:
+            self.logger.exceptions(e, batcher=self.name, size=len(items))
+            results = [e] * len(items)
+        for (_, future), result in zip(items, results):
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def close(self):
+        """
+        Flush pending items and wait for running flushes
+        """
+        self._flush_now()
+        if self._flushing:
+            await asyncio.gather(*self._flushing, return_exceptions=True)
@@ -0,0 +1,83 @@
+# @Time : 2026-10-19 00:41:09
+# @Author : Mio Lau
+# @Contact: liurusi.101@gmail.com | github.com/MioYvo
+# @File : bench_serializer.py
+"""
+Benchmark of the instance cache serializers: encode/decode time and size of typical cached documents,
+and redis memory (`MEMORY USAGE`) with `--redis`.
+
+    python -m utils.bench_serializer [--number 2000] [--redis]
+"""
+import argparse
+import datetime
+import timeit
+from decimal import Decimal
+from uuid import uuid4
+
+from bson import ObjectId
+
+from utils.encoder import JsonSerializer, BsonSerializer, lz4_frame
+
+
+def sample_event() -> dict:
+    rcs_schema = {
+        f"field_{i}": {"type": t, "desc": f"description of field {i}", "optional": bool(i % 2)}
+        for i, t in enumerate(["str", "int", "decimal", "datetime", "coin_name", "str"] * 5)
+    }
+    now = datetime.datetime.utcnow()
+    return {"id": ObjectId(), "name": "withdraw", "desc": "withdraw of coins", "rcs_schema": rcs_schema,
+            "rules": [ObjectId() for _ in range(20)], "create_at": now, "update_at": now}
+
+
+def sample_record() -> dict:
+    now = datetime.datetime.utcnow()
+    return {
+        "id": ObjectId(), "event": ObjectId(),
+        "event_data": {"coin_name": "USDT-TRC20", "amount": Decimal("123.456789"), "order_from": uuid4().hex,
+                       "order_to": uuid4().hex, "dt": now},
+        "user": {"user_id": uuid4().hex, "project": "VDEX", "chain_name": "TRON", "game_id": None,
+                 "platform_id": None},
+        "results": [{"result_id": None, "rule_id": ObjectId(), "status": "wait", "punish_level": 5,
+                     "dispatch_time": now, "done_time": None} for _ in range(20)],
+        "punish": {"total_punish_level": 0, "hit_punish_level": 0, "results_done": 0, "action": "NOTHING"},
+        "is_processed": False, "event_at": now, "create_at": now,
+    }
+
+
+SERIALIZERS = {
+    "json": JsonSerializer(),
+    "bson": BsonSerializer(compression=''),
+    "bson+zlib": BsonSerializer(compression='zlib', compress_min_size=0),
+}
+if lz4_frame is not None:
+    SERIALIZERS["bson+lz4"] = BsonSerializer(compression='lz4', compress_min_size=0)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type=int, default=2000)
+    parser.add_argument('--redis', action='store_true', help='measure MEMORY USAGE in the configured redis')
+    args = parser.parse_args()
+
+    redis = None
+    if args.redis:
+        from config.clients import redis
+
+    print(f"{'doc':<8}{'serializer':<12}{'bytes':>8}{'encode us':>12}{'decode us':>12}{'redis bytes':>13}")
+    for doc_name, doc in (("event", sample_event()), ("record", sample_record())):
+        for name, serializer in SERIALIZERS.items():
+            data = serializer.dumps(doc)
+            encode = timeit.timeit(lambda: serializer.dumps(doc), number=args.number) / args.number * 1e6
+            decode = timeit.timeit(lambda: serializer.loads(data), number=args.number) / args.number * 1e6
+            memory = ''
+            if redis is not None:
+                key = f"RCS:BENCH:{doc_name}:{name}"
+                redis.set(key, data)
+                memory = redis.memory_usage(key)
+                redis.delete(key)
+            size = len(data.encode() if isinstance(data, str) else data)
+            print(f"{doc_name:<8}{name:<12}{size:>8}{encode:>12.1f}{decode:>12.1f}{memory:>13}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,13 @@
 import asyncio
 import functools
+import hashlib
 import threading
 import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+from config import CACHE_L1_ENABLE, CACHE_L1_TTL, CACHE_L1_SIZE, CACHE_VERSION
 
 
 def ttl_lru_cache(seconds: int, maxsize: int = 128, typed: bool = False):
@@ -39,6 +45,27 @@ class Cacheable:
             return self.result
 
 
+class SingleFlight:
+    """
+    Concurrent calls with the same key share one execution, for one event loop.
+    Unlike `Cacheable` the result is not kept, the next call after it's done runs again.
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable]):
+        future = self._calls.get(key)
+        if future is None:
+            future = self._calls[key] = asyncio.ensure_future(func())
+            future.add_done_callback(lambda _: self._calls.pop(key, None))
+        # a cancelled caller must not cancel the others
+        return await asyncio.shield(future)
+
+    def __len__(self):
+        return len(self._calls)
+
+
 def async_cache(f):
     @functools.wraps(f)
     def wrapped(*args, **kwargs):
@@ -71,3 +98,75 @@ def thread_safe_async_cache(f):
         r = f(*args, **kwargs)
         return Cacheable(r)
     return wrapped
+
+
+class LocalCache:
+    """
+    In-process LRU cache with TTL, for one event loop (not thread safe).
+    With a `serializer` (`dumps`/`loads`) values are kept serialized and every `get` decodes a new copy, so callers
+    never share mutable values with the cache, e.g. raw BSON decodes faster than a deepcopy of the dict.
+    """
+    MISSING = object()
+
+    def __init__(self, ttl: int, maxsize: int = 1024, serializer=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.serializer = serializer
+        self._data: 'OrderedDict[str, Tuple[float, Any]]' = OrderedDict()
+
+    def get(self, key: str, default=MISSING):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        expire_at, value = item
+        if expire_at <= time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value if self.serializer is None else self.serializer.loads(value)
+
+    def set(self, key: str, value, ttl: Optional[int] = None):
+        if self.serializer is not None:
+            value = self.serializer.dumps(value)
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def delete(self, key: str):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+@functools.lru_cache(maxsize=None)
+def model_cache_version(model) -> str:
+    """
+    Version of a model's cached instances: CACHE_VERSION and a digest of its fields and their types, so processes
+    running another version of the model never read its instances. Restarts keep the cache.
+    """
+    fields = sorted(f"{name}:{field.outer_type_}:{field.required}" for name, field in model.__fields__.items())
+    return f"{CACHE_VERSION}.{hashlib.sha1(';'.join(fields).encode()).hexdigest()[:8]}"
+
+
+@dataclass(frozen=True)
+class CachePolicy:
+    """
+    Cache policy of a model, declared by `Model.cache_policy_()`
+    :param local: cache in the in-process L1 `LocalCache`
+    :param remote: cache in redis by `cached_instance`
+    """
+    local: bool = True
+    remote: bool = True
+    local_ttl: int = CACHE_L1_TTL
+    local_size: int = CACHE_L1_SIZE
+
+
+DEFAULT_CACHE_POLICY = CachePolicy(local=CACHE_L1_ENABLE)
+# cached for CACHE_NEGATIVE_TTL in place of documents not found
+NOT_FOUND = {"__not_found__": True}
+NO_CACHE_POLICY = CachePolicy(local=False, remote=False)
@@ -8,11 +8,18 @@ from json import JSONEncoder
 from typing import Union, Optional
 from uuid import UUID
 import json
+import zlib
 
 from aiocache.serializers import BaseSerializer
-from bson import ObjectId, Decimal128
+from bson import ObjectId, Decimal128, decode as bson_decode, encode as bson_encode
+from bson.codec_options import CodecOptions, TypeCodec, TypeRegistry
 from odmantic.model import ObjectId as odObjectID
 
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
 unicode_type = str
 _TO_UNICODE_TYPES = (unicode_type, type(None))
 
@@ -90,3 +97,72 @@ class JsonSerializer(BaseSerializer):
         return json.loads(value)
 
 
+class DecimalCodec(TypeCodec):
+    python_type = Decimal
+    bson_type = Decimal128
+
+    def transform_python(self, value):
+        return Decimal128(value)
+
+    def transform_bson(self, value):
+        return value.to_decimal()
+
+
+def _bson_fallback(o):
+    # types BSON has no counterpart for, converted as MyEncoder does
+    if isinstance(o, Enum):
+        return o.value
+    if isinstance(o, (set, frozenset)):
+        return list(o)
+    if isinstance(o, timedelta):
+        return o.total_seconds()
+    if isinstance(o, UUID):
+        return str(o)
+    raise TypeError(f"Object of type {type(o).__name__} is not BSON serializable")
+
+
+BSON_CODEC_OPTIONS = CodecOptions(type_registry=TypeRegistry([DecimalCodec()], fallback_encoder=_bson_fallback))
+
+
+class BsonSerializer(BaseSerializer):
+    """
+    Binary serializer keeping ObjectId, datetime and Decimal, values larger than `compress_min_size` bytes are
+    compressed. The first byte tells the format:
+
+        b"B" BSON, b"Z" zlib compressed BSON, b"L" lz4 compressed BSON
+
+    Values written by `JsonSerializer` are still read, so the cache can be switched without clearing it.
+    """
+    DEFAULT_ENCODING = None
+    RAW, ZLIB, LZ4 = b"B", b"Z", b"L"
+
+    def __init__(self, *args, compression: str = 'zlib', compress_min_size: int = 1024, **kwargs):
+        super(BsonSerializer, self).__init__(*args, **kwargs)
+        if compression == 'lz4' and lz4_frame is None:
+            compression = 'zlib'
+        self.compression = compression
+        self.compress_min_size = compress_min_size
+
+    def dumps(self, value) -> bytes:
+        # BSON documents are dicts, values are wrapped
+        data = bson_encode({"v": value}, codec_options=BSON_CODEC_OPTIONS)
+        if not self.compression or len(data) < self.compress_min_size:
+            return self.RAW + data
+        if self.compression == 'lz4':
+            return self.LZ4 + lz4_frame.compress(data)
+        return self.ZLIB + zlib.compress(data)
+
+    def loads(self, value: Optional[bytes]):
+        if value is None:
+            return None
+        header, data = value[:1], value[1:]
+        if header == self.RAW:
+            pass
+        elif header == self.ZLIB:
+            data = zlib.decompress(data)
+        elif header == self.LZ4:
+            data = lz4_frame.decompress(data)
+        else:
+            # written by JsonSerializer
+            return json.loads(value)
+        return bson_decode(data, codec_options=BSON_CODEC_OPTIONS)["v"]
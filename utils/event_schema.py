@@ -1,6 +1,9 @@
 # __author__ = "Mio"
 # __email__: "liurusi.101@gmail.com"
 # created: 3/30/21 7:50 PM
+import hashlib
+import json
+from collections import OrderedDict
 from copy import deepcopy
 from datetime import timedelta
 from functools import partial
@@ -12,6 +15,10 @@ from utils.gtz import Dt, local_timezone
 
 
 class EventSchema:
+    # parsed schemas keyed by content, see `compile`
+    max_compiled = 512
+    _compiled: 'OrderedDict[tuple, Schema]' = OrderedDict()
+
     @classmethod
     def type_coin_name(cls):
         # !!! cannot use async func here, wait new approach
@@ -103,6 +110,27 @@ class EventSchema:
                 _schema[k] = fn(**v)
         return Schema(_schema, ignore_extra_keys=ignore_extra_keys)
 
+    @staticmethod
+    def schema_hash(schema: dict) -> str:
+        return hashlib.sha1(json.dumps(schema, sort_keys=True, default=str).encode()).hexdigest()
+
+    @classmethod
+    def compile(cls, schema: dict, ignore_extra_keys=False) -> Schema:
+        """
+        `parse` cached by the hash of the schema. Saving an Event or Scene with another schema changes the key,
+        so the cache never serves a stale validator, unused ones are evicted as least recently used.
+        """
+        key = (cls.schema_hash(schema), ignore_extra_keys)
+        compiled = cls._compiled.get(key)
+        if compiled is None:
+            compiled = cls.parse(schema, ignore_extra_keys=ignore_extra_keys)
+            cls._compiled[key] = compiled
+            if len(cls._compiled) > cls.max_compiled:
+                cls._compiled.popitem(last=False)
+        else:
+            cls._compiled.move_to_end(key)
+        return compiled
+
     @classmethod
     def validate(cls, schema: dict, data: dict) -> dict:
-        return cls.parse(schema).validate(data)
+        return cls.compile(schema).validate(data)
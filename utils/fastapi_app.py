@@ -1,6 +1,7 @@
 # __author__ = "Mio"
 # __email__: "liurusi.101@gmail.com"
 # created: 5/12/21 11:42 PM
+import asyncio
 import base64
 import os
 import secrets
@@ -16,12 +17,12 @@ from fastapi.responses import JSONResponse
 from motor.motor_asyncio import AsyncIOMotorClient
 from pysmx.SM3 import hash_msg
 
-from config.clients import cached_instance
+from utils.amqp_publisher import AmqpPublisher
 from utils.exceptions import RCSException
 from utils.yvo_engine import YvoEngine
 from config import PROJECT_NAME, MONGO_URI, MONGO_DB, PIKA_URL, RCSExchangeName, AccessExchangeType, REDIS_DB, \
     REDIS_PASS, REDIS_CONN_MAX, REDIS_HOST, REDIS_PORT, DOCS_URL, REDOC_URL, OPENAPI_URL, ENABLE_DOC, \
-    CREATE_INDEX, CREATE_ADMIN
+    CREATE_INDEX, CREATE_ADMIN, CACHE_WARM_UP
 from utils.error_code import ERR_DB_OPERATE_FAILED
 
 if not ENABLE_DOC:
@@ -78,6 +79,7 @@ async def startup_rabbit():
         }
     )
     logger.info('rabbitMQ: connected')
+    app.state.amqp_publisher = AmqpPublisher.of(app.state.amqp_connection)
     logger.info('rabbitMQ: making queues ...')
     await make_queues(amqp_connection=app.state.amqp_connection)
     logger.info('rabbitMQ: queues made')
@@ -99,12 +101,15 @@ async def startup_mongo():
     mongo_si = await app.state.engine.client.server_info()  # si: server_info
     logger.info(f'mongo:server_info version:{mongo_si["version"]} ok:{mongo_si["ok"]}')
     logger.info('mongo: connected')
+    app.state.cache_invalidation_listener = asyncio.ensure_future(app.state.engine.listen_invalidation())
     if CREATE_INDEX:
-        from model.odm import Handler, Event, Rule, Scene, Record, Result, Config, Punishment
+        from model.odm import Handler, Event, Rule, Scene, Record, Result, Config, Punishment, AggData, \
+            AggCoverage
         logger.info('mongo indexes: creating ... (if data exists)')
         indexes = {
             _model: _model.index_()
-            for _model in [Handler, Event, Rule, Scene, Record, Result, Config, Punishment]
+            for _model in [Handler, Event, Rule, Scene, Record, Result, Config, Punishment, AggData,
+                           AggCoverage]
         }
 
         for _model, indexes in indexes.items():
@@ -141,10 +146,16 @@ async def startup_admin_user():
     # await redis.delete(key=r_key)
 
 
-async def clear_cache():
-    logger.info('cache: clearing ...')
-    await cached_instance.cache.clear()
-    logger.info('cache: cleared ...')
+async def startup_cache_warmup():
+    from utils.warmup import warm_up
+    logger.info('cache warm-up: loading ...')
+    try:
+        counts = await warm_up()
+    except Exception as e:
+        # documents are still loaded on demand, only slower
+        logger.exception(e)
+    else:
+        logger.info(f'cache warm-up: loaded {counts}')
 
 
 @app.on_event("startup")
@@ -153,30 +164,30 @@ async def startup_event():
     await startup_rabbit()
     # Redis
     await startup_redis()
-    # cache
-    await clear_cache()
     # MongoDB
     await startup_mongo()
     # User admin
     if CREATE_ADMIN:
         await startup_admin_user()
+    # Cache, before the startup events of services attach their consumers
+    if CACHE_WARM_UP:
+        await startup_cache_warmup()
 
 
 @app.on_event("shutdown")
 async def shutdown_event():
     # mongo
     logger.info('mongo: disconnecting ...')
+    app.state.cache_invalidation_listener.cancel()
     app.state.engine.client.close()
     logger.info('mongo: disconnected')
 
     # rabbitMQ
     logger.info('rabbitMQ: disconnecting ...')
+    await app.state.amqp_publisher.close()
     await app.state.amqp_connection.close()
     logger.info('rabbitMQ: disconnected')
 
-    # cache
-    await clear_cache()
-
     # redis
     logger.info('redis: disconnecting ...')
     await app.state.a_redis_pool.disconnect()
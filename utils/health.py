@@ -8,6 +8,8 @@ from fastapi import APIRouter
 router = APIRouter()
 
 
+# uvicorn serves requests only after all startup events are done (cache warm-up, consumers), so any answer means
+# the service is ready
 @router.get("/health/", tags=['health'], description='Health check')
 async def health():
     return "ok"
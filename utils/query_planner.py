@@ -0,0 +1,141 @@
+# @Time : 2026-10-18 23:52:16
+# @Author : Mio Lau
+# @Contact: liurusi.101@gmail.com | github.com/MioYvo
+# @File : query_planner.py
+"""
+Merge the MongoDB aggregations of a rule's scenes into one `$facet` aggregation.
+
+Scene scripts query Record by `YvoEngine.yvo_pipeline` with almost the same `$match`: the record's event, a
+`create_at` window and user filters. `CompiledRule.prefetch_scenes` renders all scenes of a rule concurrently with a
+`FacetBatch` set in `facet_batch`, so `yvo_pipeline` hands each aggregation to the batch instead of running it.
+Once every scene is either finished or waiting for an aggregation, the waiting ones are run together:
+
+    [{"$match": <clauses shared by all>}, {"$facet": {"s0": [{"$match": <rest of scene 0>}, ...], ...}}]
+
+Range clauses on the same field (e.g. `create_at >= now - unit_of_time`) are shared by their loosest bound, so the
+shared `$match` still uses the indexes, and every facet filters its own range again.
+Aggregations without a shared clause are run one by one as before.
+"""
+import asyncio
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional, Tuple
+
+from loguru import logger as logging
+
+# bounds merged into a shared clause, operator -> loosest of the values
+RANGE_OPERATORS = {"$gte": min, "$gt": min, "$lte": max, "$lt": max}
+
+Pipeline = List[Dict]
+
+
+def match_clauses(query: Optional[dict]) -> List[dict]:
+    if not query:
+        return []
+    if set(query) == {"$and"}:
+        return list(query["$and"])
+    return [query]
+
+
+def range_clause(clause: dict) -> Optional[Tuple[str, str, Any]]:
+    """
+    {field: {op: value}} -> (field, op, value), None if it's not a single range clause
+    """
+    if len(clause) != 1:
+        return None
+    (field, cond), = clause.items()
+    if not isinstance(cond, dict) or len(cond) != 1:
+        return None
+    (op, value), = cond.items()
+    if op not in RANGE_OPERATORS:
+        return None
+    return field, op, value
+
+
+def shared_match(queries: List[Optional[dict]]) -> Tuple[List[dict], List[List[dict]]]:
+    """
+    :return: clauses shared by all queries, clauses left for each query
+    """
+    clauses = [match_clauses(query) for query in queries]
+    shared = [clause for clause in clauses[0] if all(clause in others for others in clauses[1:])]
+    rests = [[clause for clause in _clauses if clause not in shared] for _clauses in clauses]
+
+    # (field, op) -> bounds of each query
+    ranges: Dict[Tuple[str, str], List[List[Any]]] = {}
+    for i, rest in enumerate(rests):
+        for rc in filter(None, map(range_clause, rest)):
+            ranges.setdefault(rc[:2], [[] for _ in rests])[i].append(rc[2])
+    for (field, op), bounds in ranges.items():
+        if all(bounds):
+            # every query is bounded, the loosest bound keeps all of them
+            shared.append({field: {op: RANGE_OPERATORS[op](v for values in bounds for v in values)}})
+    return shared, rests
+
+
+class FacetBatch:
+    """
+    Collects `yvo_pipeline` aggregations of concurrently rendered scenes, see module doc
+    """
+
+    def __init__(self, participants: int):
+        self.active = participants
+        self._pending: List[Tuple[Any, Optional[dict], Pipeline, asyncio.Future]] = []
+
+    async def aggregate(self, collection, query: Optional[dict], pipeline: Pipeline) -> List[Dict]:
+        future = asyncio.get_event_loop().create_future()
+        self._pending.append((collection, query, pipeline, future))
+        self._maybe_flush()
+        return await future
+
+    def done(self):
+        """
+        A participant finished, it won't aggregate any more
+        """
+        self.active -= 1
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        if self._pending and len(self._pending) >= self.active:
+            items, self._pending = self._pending, []
+            asyncio.ensure_future(self._run(items))
+
+    async def _run(self, items):
+        by_collection: Dict[str, list] = {}
+        for item in items:
+            by_collection.setdefault(item[0].full_name, []).append(item)
+        for group in by_collection.values():
+            try:
+                results = await self._aggregate(group[0][0], [(query, pipeline) for _, query, pipeline, _ in group])
+            except Exception as e:
+                results = [e] * len(group)
+            for (_, _, _, future), result in zip(group, results):
+                if future.done():
+                    continue
+                if isinstance(result, BaseException):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    @staticmethod
+    async def _aggregate(collection, queries: List[Tuple[Optional[dict], Pipeline]]) -> List[List[Dict]]:
+        shared, rests = shared_match([query for query, _ in queries]) if len(queries) > 1 else ([], [])
+        if not shared:
+            return await asyncio.gather(*[
+                collection.aggregate(([{"$match": query}] if query else []) + pipeline).to_list(None)
+                for query, pipeline in queries
+            ], return_exceptions=True)
+
+        facets = {
+            f"s{i}": ([{"$match": {"$and": rest}}] if rest else []) + pipeline
+            for i, (rest, (_, pipeline)) in enumerate(zip(rests, queries))
+        }
+        docs = await collection.aggregate([
+            {"$match": {"$and": shared} if len(shared) > 1 else shared[0]},
+            {"$facet": facets},
+        ]).to_list(None)
+        logging.info(f"facet:{len(facets)} aggregations in one")
+        doc = docs[0] if docs else {}
+        return [doc.get(f"s{i}", []) for i in range(len(queries))]
+
+
+# set by `CompiledRule.prefetch_scenes`, read by `YvoEngine.yvo_pipeline`
+facet_batch: ContextVar[Optional[FacetBatch]] = ContextVar('facet_batch', default=None)
@@ -0,0 +1,417 @@
+# @Time : 2026-10-18 20:05:12
+# @Author : Mio Lau
+# @Contact: liurusi.101@gmail.com | github.com/MioYvo
+# @File : rule_compiler.py
+"""
+Compile `Rule.rule` lists into a tree of Python closures.
+
+`RuleParser._evaluate` re-interprets the nested list on every message: it maps over every node, resolves
+`Functions.ALIAS` and `getattr` and converts Decimal128 args on every operator call.
+`RuleCompiler` does all of that once per rule content:
+
+* operator names are resolved at compile time,
+* sub-trees without dynamic nodes are folded into constants,
+* `and`/`or` short-circuit instead of evaluating every branch,
+  cheap branches are moved before expensive ones by the estimated cost of their dynamic nodes.
+
+Dynamic nodes (scene nodes, `DATA::` and `REPL::` args) become *slots*. They are rendered per record by
+`RuleParser.render_rule`, which keeps the shape of the rule, so a slot is read from the rendered rule by its path.
+
+`CompiledRule.render` is the lazy alternative of `RuleParser.render_rule`: slots are only rendered when an
+`and`/`or` needs them, skipped branches are rendered as `None`. The compiled rule evaluates branches in the same
+order, so it never reads a skipped branch.
+"""
+import asyncio
+import hashlib
+import json
+import operator
+from collections import OrderedDict
+from copy import deepcopy
+from dataclasses import dataclass
+from enum import Enum
+from functools import reduce
+from typing import Any, Awaitable, Callable, Dict, FrozenSet, List, Optional, Sequence, Tuple, Union
+
+from bson import Decimal128
+from loguru import logger as logging
+
+from SceneScript import scripts_manager
+from config import RULE_LAZY_RENDER, RULE_SCENE_FACET
+from model.odm import Rule, Record
+from utils.query_planner import FacetBatch, facet_batch
+from utils.rule_operator import Functions, RuleParser, RuleEvaluationError
+
+Path = Tuple[int, ...]
+Reader = Callable[[int], Any]
+Resolver = Callable[[int], Awaitable[Any]]
+Node = Callable[[Reader], Any]
+AsyncNode = Callable[[Resolver], Awaitable[Any]]
+
+# estimated cost of `DATA::` args, which query the latest record
+DATA_COST = 10
+
+
+class RuleShapeError(RuleEvaluationError):
+    """Rendered rule does not match the shape of the compiled rule"""
+    pass
+
+
+def _convert(arg):
+    return arg.to_decimal() if isinstance(arg, Decimal128) else arg
+
+
+# Plain implementations of `Functions`, args are already converted by the compiler
+OPERATORS = {
+    'eq': lambda *args: args[0] == args[1],
+    'neq': lambda *args: args[0] != args[1],
+    'gt': lambda *args: args[0] > args[1],
+    'gte': lambda *args: args[0] >= args[1],
+    'lt': lambda *args: args[0] < args[1],
+    'lte': lambda *args: args[0] <= args[1],
+    'in_': lambda *args: args[0] in args[1:],
+    'not_': lambda *args: not args[0],
+    'plus': lambda *args: sum(args),
+    'minus': lambda *args: reduce(operator.sub, args),
+    'multiply': lambda *args: reduce(operator.mul, args),
+    'divide': lambda *args: reduce(operator.truediv, args),
+    'abs': lambda *args: abs(args[0]),
+}
+
+
+class SlotKind(str, Enum):
+    scene = 'scene'
+    data = 'data'
+    replace = 'replace'
+
+
+@dataclass
+class Slot:
+    path: Path
+    kind: SlotKind
+    node: Union[list, str]
+    cost: int
+    # path of the nearest `and`/`or` branch containing this slot, the branch is skipped as a whole
+    guard: Optional[Path]
+
+
+@dataclass
+class Compiled:
+    node: Node
+    async_node: AsyncNode
+    cost: int = 0
+    # indexes of slots read by every evaluation of the node, whatever `and`/`or` short-circuit
+    certain: FrozenSet[int] = frozenset()
+
+
+class CompiledRule(object):
+    def __init__(self, rule: list):
+        RuleParser.validate(rule)
+        self.rule = deepcopy(rule)
+        self.slot_info: List[Slot] = []
+        self.slots: List[Path] = []
+        compiled = self._compile(self.rule, (), None)
+        self.root: Node = compiled.node
+        self.async_root: AsyncNode = compiled.async_node
+        self.certain: FrozenSet[int] = compiled.certain
+
+    # ------------------------------ compile ------------------------------
+    @staticmethod
+    def is_scene(node: list) -> bool:
+        return any(
+            isinstance(rl, str) and rl.upper() in (RuleParser.SCENE_PREFIX, RuleParser.SCENE_PREFIX[:-2])
+            for rl in node
+        )
+
+    def _slot(self, path: Path, kind: SlotKind, node, guard: Optional[Path]) -> Compiled:
+        if kind == SlotKind.scene:
+            cost = scripts_manager.cost(node[1]) if len(node) > 1 and isinstance(node[1], str) else DATA_COST
+        elif kind == SlotKind.data:
+            cost = DATA_COST
+        else:
+            cost = 0
+        index = len(self.slots)
+        self.slots.append(path)
+        self.slot_info.append(Slot(path=path, kind=kind, node=node, cost=cost, guard=guard))
+
+        async def _resolve(resolve):
+            return await resolve(index)
+        return Compiled(lambda read: read(index), _resolve, cost, frozenset([index]))
+
+    def _compile(self, node, path: Path, guard: Optional[Path]) -> Compiled:
+        if isinstance(node, list):
+            if self.is_scene(node):
+                return self._slot(path, SlotKind.scene, node, guard)
+            return self._compile_call(node, path, guard)
+        if isinstance(node, str) and node.startswith(RuleParser.DATA_PREFIX):
+            return self._slot(path, SlotKind.data, node, guard)
+        if isinstance(node, str) and node.startswith(RuleParser.REPLACE_PREFIX):
+            return self._slot(path, SlotKind.replace, node, guard)
+        return Const(_convert(node))
+
+    def _compile_call(self, node: list, path: Path, guard: Optional[Path]) -> Compiled:
+        if not node or not isinstance(node[0], str):
+            raise RuleEvaluationError(f'Rule node must start with a function name, got {node}')
+        func_name = Functions.ALIAS.get(node[0]) or node[0]
+        is_bool = func_name in ('and_', 'or_')
+        args = [
+            self._compile(arg, path + (i,), path + (i,) if is_bool else guard)
+            for i, arg in enumerate(node[1:], start=1)
+        ]
+
+        if func_name == 'and_':
+            return self._compile_bool(args, stop_at=False)
+        if func_name == 'or_':
+            return self._compile_bool(args, stop_at=True)
+
+        func = OPERATORS.get(func_name) or getattr(Functions, func_name, None)
+        if func is None:
+            raise RuleEvaluationError(f'Unsupported function {node[0]}')
+
+        if all(isinstance(arg, Const) for arg in args):
+            try:
+                return Const(func(*[arg.value for arg in args]))
+            except Exception as e:
+                # leave it to evaluation, errors are raised when the rule is evaluated as before
+                logging.debug(f'constant folding failed: {node} {e}')
+
+        nodes = [arg.node for arg in args]
+        if len(nodes) == 1:
+            a, = nodes
+            _node = lambda read: func(a(read))
+        elif len(nodes) == 2:
+            a, b = nodes
+            _node = lambda read: func(a(read), b(read))
+        else:
+            _node = lambda read: func(*[n(read) for n in nodes])
+
+        async_nodes = [arg.async_node for arg in args]
+
+        async def _async_node(resolve):
+            return func(*[await n(resolve) for n in async_nodes])
+        return Compiled(_node, _async_node, sum(arg.cost for arg in args),
+                        frozenset().union(*[arg.certain for arg in args]))
+
+    @staticmethod
+    def _compile_bool(args: List[Compiled], stop_at: bool) -> Compiled:
+        """
+        `and`: stop_at False; `or`: stop_at True
+        """
+        branches = []
+        for arg in args:
+            if isinstance(arg, Const):
+                if bool(arg.value) is stop_at:
+                    return Const(stop_at)
+                # neutral constant, drop it
+                continue
+            branches.append(arg)
+        if not branches:
+            return Const(not stop_at)
+        # cheap branches first, `sorted` is stable so equal costs keep the order of the rule
+        branches.sort(key=lambda x: x.cost)
+        nodes = [branch.node for branch in branches]
+        async_nodes = [branch.async_node for branch in branches]
+
+        def _bool(read):
+            for _node in nodes:
+                if bool(_node(read)) is stop_at:
+                    return stop_at
+            return not stop_at
+
+        async def _async_bool(resolve):
+            for _node in async_nodes:
+                if bool(await _node(resolve)) is stop_at:
+                    return stop_at
+            return not stop_at
+        # only the first branch is always evaluated
+        return Compiled(_bool, _async_bool, sum(branch.cost for branch in branches), branches[0].certain)
+
+    # ------------------------------ evaluate ------------------------------
+    def reader(self, rendered: list) -> Reader:
+        slots = self.slots
+
+        def read(index: int):
+            path = slots[index]
+            if not path:
+                # only one scene in rule, rendered as [bool] by dispatcher
+                return rendered[0] if isinstance(rendered, list) else rendered
+            value = rendered
+            try:
+                for i in path:
+                    value = value[i]
+            except (IndexError, TypeError, KeyError) as e:
+                raise RuleShapeError(f'slot {path} not found in rendered rule: {e}')
+            return _convert(value)
+        return read
+
+    def evaluate(self, rendered: Optional[list] = None) -> Any:
+        """
+        :param rendered: rule rendered by `RuleParser.render_rule`
+        :return:
+        """
+        ret = self.root(self.reader(rendered or []))
+        if not isinstance(ret, bool):
+            logging.warning('In common usage, a rule must return a bool value,'
+                            f'but get {ret}, please check the rule to ensure it is true')
+        return ret
+
+    # ------------------------------ render ------------------------------
+    async def render_slot(self, index: int, record: Record):
+        slot = self.slot_info[index]
+        if slot.kind == SlotKind.scene:
+            return await RuleParser._render_scene(deepcopy(slot.node), record)
+        elif slot.kind == SlotKind.data:
+            return await RuleParser.get_data(slot.node)
+        else:
+            return RuleParser.replace_data(slot.node, record.event_data)
+
+    @property
+    def scene_slots(self) -> List[int]:
+        """
+        Scene slots read by every evaluation, so prefetching them doesn't defeat the short-circuit of `render`
+        """
+        return [index for index, slot in enumerate(self.slot_info)
+                if slot.kind == SlotKind.scene and index in self.certain]
+
+    async def prefetch_scenes(self, record: Record) -> Dict[int, Any]:
+        """
+        Render `scene_slots` concurrently, their `yvo_pipeline` aggregations are merged into one `$facet`
+        aggregation by `FacetBatch`. Other slots and slots failed to render are left to `render`.
+        :return: slot index -> rendered scene
+        """
+        indexes = self.scene_slots
+        batch = FacetBatch(participants=len(indexes))
+
+        async def _render(index: int):
+            try:
+                return await self.render_slot(index, record)
+            finally:
+                batch.done()
+
+        token = facet_batch.set(batch)
+        try:
+            # tasks copy the context, so every scene sees the batch
+            results = await asyncio.gather(*[_render(index) for index in indexes], return_exceptions=True)
+        finally:
+            facet_batch.reset(token)
+        rendered = {}
+        for index, result in zip(indexes, results):
+            if isinstance(result, Exception):
+                logging.warning(f'prefetch scene failed: {self.slot_info[index].node} {result}')
+            else:
+                rendered[index] = result
+        return rendered
+
+    async def render(self, record: Record, rendered: Optional[Dict[int, Any]] = None) -> Union[list, Any]:
+        """
+        Lazy version of `RuleParser.render_rule`, only slots needed by `and`/`or` are rendered.
+        :param record:
+        :param rendered: slots already rendered, e.g. by `prefetch_scenes`
+        :return: rendered rule, skipped branches are None. Same as `render_rule`, a rule which is only one scene
+            is rendered as the scene result.
+        """
+        rendered: Dict[int, Any] = dict(rendered or {})
+
+        async def resolve(index: int):
+            if index not in rendered:
+                rendered[index] = await self.render_slot(index, record)
+            return _convert(rendered[index])
+
+        await self.async_root(resolve)
+
+        rule = deepcopy(self.rule)
+        for index, slot in enumerate(self.slot_info):
+            if not slot.path:
+                return rendered[index]
+            if index in rendered:
+                self._set_path(rule, slot.path, rendered[index])
+        for index, slot in enumerate(self.slot_info):
+            if index not in rendered and slot.guard is not None:
+                self._set_path(rule, slot.guard, None)
+        return rule
+
+    @staticmethod
+    def _set_path(rule: list, path: Path, value):
+        node = rule
+        for i in path[:-1]:
+            node = node[i]
+            if node is None:
+                # inside a skipped branch
+                return
+        node[path[-1]] = value
+
+
+class Const(Compiled):
+    """Folded node"""
+
+    def __init__(self, value):
+        self.value = value
+
+        async def _async_node(resolve):
+            return value
+        super(Const, self).__init__(node=lambda read: value, async_node=_async_node, cost=0)
+
+
+class RuleCompiler(object):
+    """
+    Compiled rules cache, keyed by the hash of `Rule.rule`. `Rule.update_at` is whatever the client saved, so an
+    edited rule gets a new key by its content, unused compiled rules are evicted as least recently used.
+    """
+    max_size = 1024
+    _compiled: 'OrderedDict[str, CompiledRule]' = OrderedDict()
+    # rule id -> (copy of `Rule.rule`, its hash), comparing the content is cheaper than hashing it again
+    _hashes: Dict[Any, Tuple[list, str]] = {}
+
+    @classmethod
+    def compile(cls, rule: Sequence) -> CompiledRule:
+        return CompiledRule(list(rule))
+
+    @staticmethod
+    def rule_hash(rule: Sequence) -> str:
+        return hashlib.sha1(json.dumps(rule, sort_keys=True, default=str).encode()).hexdigest()
+
+    @classmethod
+    def hash_of(cls, rule: Rule) -> str:
+        """
+        `rule_hash` of `rule.rule`, memoized per rule id while its content is the same
+        """
+        memo = cls._hashes.get(rule.id)
+        if memo is not None and memo[0] == rule.rule:
+            return memo[1]
+        rule_hash = cls.rule_hash(rule.rule)
+        cls._hashes[rule.id] = (deepcopy(rule.rule), rule_hash)
+        return rule_hash
+
+    @classmethod
+    def get(cls, rule: Rule) -> CompiledRule:
+        key = cls.hash_of(rule)
+        compiled = cls._compiled.get(key)
+        if compiled is None:
+            compiled = cls.compile(rule.rule)
+            cls._compiled[key] = compiled
+            if len(cls._compiled) > cls.max_size:
+                cls._compiled.popitem(last=False)
+        else:
+            cls._compiled.move_to_end(key)
+        return compiled
+
+    @classmethod
+    def clear(cls):
+        cls._compiled.clear()
+
+    @classmethod
+    async def render(cls, rule: Rule, record: Record) -> list:
+        """
+        Render a rule for `record`, lazily if `RULE_LAZY_RENDER`, scenes every evaluation reads at once by one
+        `$facet` aggregation if `RULE_SCENE_FACET`
+        :return: rendered rule, a rule which is only one scene is rendered as [scene result]
+        """
+        compiled = cls.get(rule) if RULE_SCENE_FACET or RULE_LAZY_RENDER else None
+        if RULE_SCENE_FACET and len(compiled.scene_slots) > 1:
+            rendered = await compiled.render(record, rendered=await compiled.prefetch_scenes(record))
+        elif RULE_LAZY_RENDER:
+            rendered = await compiled.render(record)
+        else:
+            rendered = await RuleParser.render_rule(deepcopy(rule.rule), record)
+        if not isinstance(rendered, list):
+            rendered = [rendered]
+        return rendered
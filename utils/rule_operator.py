@@ -11,6 +11,7 @@ from loguru import logger as logging
 from bson import Decimal128, ObjectId
 
 from SceneScript import scripts_manager
+from SceneScript.register import current_scene
 from model.odm import Event, Scene, Record
 from utils import Operator
 from utils.fastapi_app import app
@@ -270,7 +271,7 @@ class RuleParser(object):
         """
         assert len(scene_rule) >= 3
 
-        scene = await app.state.engine.find_one(Scene, Scene.name == scene_rule[1])
+        scene = await app.state.engine.get_by_unique(Scene, 'name', scene_rule[1])
         kwargs = dict()
         origin_data = dict()
         for rl in scene_rule[2:]:
@@ -295,7 +296,11 @@ class RuleParser(object):
             raise Exception(f"Failed validate scene schema: {valid_data}")
         scene_script: Callable = scripts_manager.scene_scripts[scene.name]
         logging.info(f"{scene_script=}: {kwargs=}")
-        rendered_rule: bool = await scene_script(record, kwargs)
+        token = current_scene.set(scene.id)
+        try:
+            rendered_rule: bool = await scene_script(record, kwargs)
+        finally:
+            current_scene.reset(token)
         return rendered_rule
 
     @classmethod
@@ -0,0 +1,128 @@
+# @Time : 2026-10-18 22:48:05
+# @Author : Mio Lau
+# @Contact: liurusi.101@gmail.com | github.com/MioYvo
+# @File : ruleset.py
+"""
+Immutable snapshot of the rules effective for each (event, project), used by DataProcessor to dispatch records.
+
+`Record.rules()` plus the `Rule` query cost 3+N database and cache round-trips per record. The snapshot is built from
+all Events, Scenes and ON Rules at once and rules are compiled by `RuleCompiler` while building it, so dispatch is a
+dict lookup.
+
+Saving or deleting a Rule, Scene or Event invalidates its cache, `YvoEngine.invalidate_local` reports it here (also
+for other services through the pub/sub invalidation channel) and the next lookup builds a new snapshot, which then
+replaces the old one as a whole. Caches are invalidated after the write, but a read started before the write may
+still cache the old document, so a snapshot built within `SETTLE_SECONDS` of an invalidation is used once but
+rebuilt by the next lookup.
+"""
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Mapping, Optional, Sequence, Tuple
+
+from bson import ObjectId
+
+from config import RULESET_SNAPSHOT_TTL
+from model.odm import Event, Rule, Scene, Status
+from utils.fastapi_app import app
+from utils.logger import Logger
+from utils.rule_compiler import RuleCompiler
+
+SETTLE_SECONDS = 1
+
+
+@dataclass(frozen=True)
+class RulesetSnapshot:
+    version: int
+    # (event id, project) -> ON rules
+    rules: Mapping[Tuple[ObjectId, str], Tuple[Rule, ...]]
+    # event id -> ids of scenes referring the event
+    scenes: Mapping[ObjectId, Tuple[ObjectId, ...]]
+    built_at: float = field(default_factory=time.monotonic)
+
+    def get(self, event: ObjectId, project: str) -> Tuple[Rule, ...]:
+        return self.rules.get((event, project), ())
+
+
+class RulesetManager:
+    logger = Logger(name='Ruleset')
+    models = {Rule.__name__, Scene.__name__, Event.__name__}
+
+    def __init__(self, ttl: int = RULESET_SNAPSHOT_TTL):
+        self.ttl = ttl
+        self.snapshot: Optional[RulesetSnapshot] = None
+        self._invalidated_at = 0.
+        self._lock: Optional[asyncio.Lock] = None
+
+    def invalidate(self, model_name: Optional[str], primary_keys: Sequence[str] = ()):
+        """
+        Callback of `YvoEngine.invalidation_callbacks`
+        """
+        if model_name is None or model_name in self.models:
+            self._invalidated_at = time.monotonic()
+
+    def is_fresh(self, snapshot: Optional[RulesetSnapshot]) -> bool:
+        return snapshot is not None \
+            and snapshot.built_at >= self._invalidated_at + SETTLE_SECONDS \
+            and time.monotonic() - snapshot.built_at < self.ttl
+
+    async def current(self) -> RulesetSnapshot:
+        snapshot = self.snapshot
+        if self.is_fresh(snapshot):
+            return snapshot
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            # built by another coroutine while waiting
+            if self.snapshot is not snapshot and self.snapshot.built_at >= self._invalidated_at:
+                return self.snapshot
+            self.snapshot = await self.build(version=snapshot.version + 1 if snapshot else 1)
+            return self.snapshot
+
+    async def rules(self, event: ObjectId, project: str) -> List[Rule]:
+        return list((await self.current()).get(event, project))
+
+    async def scenes(self, event: ObjectId) -> List[ObjectId]:
+        return list((await self.current()).scenes.get(event, ()))
+
+    async def build(self, version: int) -> RulesetSnapshot:
+        built_at = time.monotonic()
+        events: List[Event] = await app.state.engine.find(Event)
+        scenes: List[Scene] = await app.state.engine.find(Scene)
+        rules: List[Rule] = await app.state.engine.find(Rule, Rule.status == Status.ON)
+
+        on_rules = {rule.id: rule for rule in rules}
+        for rule in rules:
+            try:
+                RuleCompiler.get(rule)
+            except Exception as e:
+                self.logger.exceptions(e, where='compile', rule=rule.id)
+
+        event_scenes: Dict[ObjectId, List[Scene]] = {}
+        for scene in scenes:
+            for event_id in scene.events:
+                event_scenes.setdefault(event_id, []).append(scene)
+
+        snapshot_rules: Dict[Tuple[ObjectId, str], List[Rule]] = {}
+        for event in events:
+            rule_ids = set(event.rules)
+            for scene in event_scenes.get(event.id, []):
+                rule_ids.update(scene.rules)
+            for rule_id in sorted(rule_ids):
+                rule = on_rules.get(rule_id)
+                if not rule:
+                    continue
+                for project in rule.project:
+                    snapshot_rules.setdefault((event.id, project), []).append(rule)
+
+        snapshot = RulesetSnapshot(
+            version=version,
+            rules={k: tuple(v) for k, v in snapshot_rules.items()},
+            scenes={k: tuple(scene.id for scene in v) for k, v in event_scenes.items()},
+            built_at=built_at,
+        )
+        self.logger.info('SnapshotBuilt', version=version, keys=len(snapshot.rules), rules=len(on_rules))
+        return snapshot
+
+
+ruleset = RulesetManager()
@@ -0,0 +1,15 @@
+# @Time : 2026-10-19 02:10:41
+# @Author : Mio Lau
+# @Contact: liurusi.101@gmail.com | github.com/MioYvo
+# @File : test_query_planner.py
+from utils.query_planner import shared_match
+
+
+def test_facet_shared_match():
+    q1 = {'$and': [{'event': {'$eq': 1}}, {'create_at': {'$gte': 10}}, {'user.user_id': {'$eq': 'a'}}]}
+    q2 = {'$and': [{'event': {'$eq': 1}}, {'create_at': {'$gte': 5}}, {'event_data.coin_name': {'$eq': 'USDT'}}]}
+    shared, rests = shared_match([q1, q2])
+    # loosest create_at bound is shared, each facet keeps its own
+    assert shared == [{'event': {'$eq': 1}}, {'create_at': {'$gte': 5}}]
+    assert rests == [[{'create_at': {'$gte': 10}}, {'user.user_id': {'$eq': 'a'}}],
+                     [{'create_at': {'$gte': 5}}, {'event_data.coin_name': {'$eq': 'USDT'}}]]
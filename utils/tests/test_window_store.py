@@ -0,0 +1,11 @@
+# @Time : 2026-10-19 02:11:05
+# @Author : Mio Lau
+# @Contact: liurusi.101@gmail.com | github.com/MioYvo
+# @File : test_window_store.py
+from utils.window_store import WindowStore
+
+
+def test_distinct_max_error_band():
+    # 3% from the threshold: decided by the estimate at 2% error, counted exactly at 5%
+    assert WindowStore.is_decisive(1030, 1000, max_error=0.02) is True
+    assert WindowStore.is_decisive(1030, 1000, max_error=0.05) is False
@@ -0,0 +1,47 @@
+# @Time : 2026-10-19 01:32:40
+# @Author : Mio Lau
+# @Contact: liurusi.101@gmail.com | github.com/MioYvo
+# @File : warmup.py
+"""
+Cache warm-up at startup, run by `utils.fastapi_app.startup_event` before the services' consumers attach.
+
+The first records after a deploy or a `CACHE_VERSION` bump would otherwise load every Rule, Event, Scene and Config
+one by one from MongoDB while the queues are full. ON rules, the events and scenes referring them and configs are
+loaded in bulk by `YvoEngine.find` (which caches them in L1 and redis), the `get_by_unique` mappings of `Event.name`
+and `Scene.name` are cached, rules are compiled and event schemas are compiled by parsing the events.
+"""
+import time
+from typing import Dict
+
+from model.odm import Config, Event, Rule, Scene, Status
+from utils.fastapi_app import app
+from utils.logger import Logger
+from utils.rule_compiler import RuleCompiler
+
+logger = Logger(name='CacheWarmUp')
+
+
+async def warm_up() -> Dict[str, int]:
+    """
+    :return: model name -> number of cached documents
+    """
+    started = time.monotonic()
+    engine = app.state.engine
+    rules = await engine.find(Rule, Rule.status == Status.ON)
+    rule_ids = [rule.id for rule in rules]
+    events = await engine.find(Event, {"rules": {"$in": rule_ids}}) if rule_ids else []
+    scenes = await engine.find(Scene, {"rules": {"$in": rule_ids}}) if rule_ids else []
+    configs = await engine.find(Config)
+    await engine.set_unique_cache(Event, events, 'name')
+    await engine.set_unique_cache(Scene, scenes, 'name')
+
+    for rule in rules:
+        try:
+            RuleCompiler.get(rule)
+        except Exception as e:
+            logger.exceptions(e, where='compile', rule=rule.id)
+
+    counts = {Rule.__name__: len(rules), Event.__name__: len(events), Scene.__name__: len(scenes),
+              Config.__name__: len(configs)}
+    logger.info('Done', seconds=round(time.monotonic() - started, 3), **counts)
+    return counts
@@ -0,0 +1,307 @@
+# @Time : 2026-10-18 21:12:40
+# @Author : Mio Lau
+# @Contact: liurusi.101@gmail.com | github.com/MioYvo
+# @File : window_store.py
+"""
+Incremental window store for `*_per_time_limit` scenes.
+
+Every saved Record increases a count and an amount sum in a redis hash per time bucket, keyed by event and
+one of the configured dimension sets (`WINDOW_DIMENSIONS`), e.g.
+
+    RCS:WIN:<event_id>:user.project=VDEX&user.user_id=abc:<bucket>  ->  {"n": 3, "s": "12.5"}
+
+A scene reads the whole buckets of its `unit_of_time` instead of scanning Record in MongoDB, only the part of the
+window before its first whole bucket (less than `WINDOW_BUCKET_SECONDS`) is counted in MongoDB by `exact_window`,
+so the window is exactly the one of the MongoDB query. Scenes fall back to MongoDB when their filters don't match a
+configured dimension set.
+
+Distinct counts (`multi_*_to_one`, `contract_addr_num_per_time_limit`) use time-bucketed redis HyperLogLogs
+(`Sketch`), maintained the same way and merged by one PFCOUNT. Scenes opt in with a `max_error`, see
+`WindowStore.distinct`.
+
+Counters only cover records saved after the store is enabled, enable it at least `unit_of_time` before rules rely
+on it.
+"""
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from typing import Any, Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+from bson import Decimal128
+
+from config import CACHE_NAMESPACE, RULE_ENGINE_USER_DATA_FORMAT, WINDOW_STORE_ENABLE, WINDOW_BUCKET_SECONDS, \
+    WINDOW_MAX_SECONDS, WINDOW_DIMENSIONS, DISTINCT_BUCKET_SECONDS, DISTINCT_DIMENSIONS
+from model.odm import Record
+from utils import Operator
+from utils.fastapi_app import app
+from utils.logger import Logger
+
+# KEYS: bucket keys; ARGV[1]: amount, ARGV[2]: ttl
+INCR_SCRIPT = """
+for _, key in ipairs(KEYS) do
+    redis.call('HINCRBY', key, 'n', 1)
+    redis.call('HINCRBYFLOAT', key, 's', ARGV[1])
+    redis.call('EXPIRE', key, ARGV[2])
+end
+return #KEYS
+"""
+
+# KEYS[1]: bucket key prefix; ARGV[1]: first bucket, ARGV[2]: last bucket
+SUM_SCRIPT = """
+local n, s = 0, 0
+for b = tonumber(ARGV[1]), tonumber(ARGV[2]) do
+    local v = redis.call('HMGET', KEYS[1] .. b, 'n', 's')
+    if v[1] then n = n + tonumber(v[1]) end
+    if v[2] then s = s + tonumber(v[2]) end
+end
+return {n, tostring(s)}
+"""
+
+# KEYS: HyperLogLog keys; ARGV[1]: ttl, ARGV[i + 1]: element of KEYS[i]
+PFADD_SCRIPT = """
+for i, key in ipairs(KEYS) do
+    redis.call('PFADD', key, ARGV[i + 1])
+    redis.call('EXPIRE', key, ARGV[1])
+end
+return #KEYS
+"""
+
+# standard error of redis HyperLogLog, 1.04 / sqrt(16384)
+HLL_STANDARD_ERROR = 0.0081
+
+
+@dataclass
+class Sketch:
+    """
+    Distinct count of `element` per `dimension` value, e.g. distinct users withdrawing to one address
+    """
+    name: str
+    dimension: str
+    element: str
+    extra_dimensions: List[FrozenSet[str]] = field(default_factory=lambda: list(DISTINCT_DIMENSIONS))
+
+    @property
+    def dimensions(self) -> List[FrozenSet[str]]:
+        return [frozenset({self.dimension})] + [frozenset({self.dimension}) | d for d in self.extra_dimensions]
+
+
+ORDER_TO_USERS = Sketch(name='order_to_users', dimension='event_data.order_to', element='user.user_id')
+USER_CONTRACTS = Sketch(name='user_contracts', dimension='user.user_id',
+                        element='event_data.coin_contract_address')
+
+
+class WindowStore:
+    logger = Logger(name='WindowStore')
+    prefix = f"{CACHE_NAMESPACE}:WIN"
+
+    def __init__(self, dimensions: Iterable[FrozenSet[str]] = WINDOW_DIMENSIONS,
+                 bucket_seconds: int = WINDOW_BUCKET_SECONDS, enable: bool = WINDOW_STORE_ENABLE,
+                 sketches: Iterable[Sketch] = (ORDER_TO_USERS, USER_CONTRACTS),
+                 sketch_bucket_seconds: int = DISTINCT_BUCKET_SECONDS):
+        self.dimensions = list(dimensions)
+        self.bucket_seconds = bucket_seconds
+        self.enable = enable
+        self.sketches = list(sketches)
+        self.sketch_bucket_seconds = sketch_bucket_seconds
+        self._scripts = {}
+
+    def _script(self, name: str, lua: str):
+        # scripts are registered on the redis client created at startup
+        redis = app.state.a_redis
+        script = self._scripts.get(name)
+        if script is None or script.registered_client is not redis:
+            script = self._scripts[name] = redis.register_script(lua)
+        return script
+
+    def bucket(self, ts: float, bucket_seconds: Optional[int] = None) -> int:
+        return int(ts // (bucket_seconds or self.bucket_seconds))
+
+    @staticmethod
+    def dims_key(dims: Dict[str, str]) -> str:
+        return '&'.join(f"{k}={v}" for k, v in sorted(dims.items()))
+
+    def key_prefix(self, event, dims: Dict[str, str], sketch: Optional[Sketch] = None) -> str:
+        if sketch:
+            return f"{self.prefix}:HLL:{sketch.name}:{event}:{self.dims_key(dims)}:"
+        return f"{self.prefix}:{event}:{self.dims_key(dims)}:"
+
+    @staticmethod
+    def record_value(record: Record, dim: str):
+        source, _, name = dim.partition('.')
+        return getattr(record.user, name, None) if source == 'user' else record.event_data.get(name)
+
+    def record_dims(self, record: Record, dimensions: Iterable[str]) -> Optional[Dict[str, str]]:
+        dims = {}
+        for dim in dimensions:
+            value = self.record_value(record, dim)
+            if value is None:
+                return None
+            dims[dim] = str(value)
+        return dims
+
+    async def incr(self, record: Record) -> None:
+        """
+        Count a saved record in all dimension sets it has values for
+        """
+        if not self.enable:
+            return
+        bucket = self.bucket(record.create_at.replace(tzinfo=timezone.utc).timestamp())
+        keys = []
+        for dimensions in self.dimensions:
+            dims = self.record_dims(record, dimensions)
+            if dims is not None:
+                keys.append(f"{self.key_prefix(record.event, dims)}{bucket}")
+        amount = record.event_data.get('amount') or 0
+        try:
+            if keys:
+                await self._script('incr', INCR_SCRIPT)(
+                    keys=keys, args=[str(amount), WINDOW_MAX_SECONDS + self.bucket_seconds])
+            await self.pfadd(record)
+        except Exception as e:
+            self.logger.exceptions(e, where='incr', record=record.id)
+
+    async def pfadd(self, record: Record) -> None:
+        bucket = self.bucket(record.create_at.replace(tzinfo=timezone.utc).timestamp(), self.sketch_bucket_seconds)
+        keys, elements = [], []
+        for sketch in self.sketches:
+            element = self.record_value(record, sketch.element)
+            if element is None:
+                continue
+            for dimensions in sketch.dimensions:
+                dims = self.record_dims(record, dimensions)
+                if dims is not None:
+                    keys.append(f"{self.key_prefix(record.event, dims, sketch)}{bucket}")
+                    elements.append(str(element))
+        if keys:
+            await self._script('pfadd', PFADD_SCRIPT)(
+                keys=keys, args=[WINDOW_MAX_SECONDS + self.sketch_bucket_seconds, *elements])
+
+    @staticmethod
+    def scene_dims(record: Record, kwargs: Dict[str, Operator],
+                   event_data_opt_names: Iterable[str] = (),
+                   user_opt_names: Iterable[str] = (), raw: bool = False) -> Optional[Dict[str, Any]]:
+        """
+        Dimensions of a scene's filters, None if they are not equalities
+        :param raw: values as they are instead of strings of keys, to query Record with
+        """
+        dims = {}
+        for source, opt_names in (('event_data', event_data_opt_names), ('user', user_opt_names)):
+            for opt_name in opt_names:
+                opt = kwargs.get(opt_name)
+                if not opt:
+                    continue
+                if opt.func_name != 'eq':
+                    return None
+                if opt.data == RULE_ENGINE_USER_DATA_FORMAT:
+                    value = getattr(record.user, opt_name, None) if source == 'user' \
+                        else record.event_data.get(opt_name)
+                else:
+                    value = opt.data
+                dims[f"{source}.{opt_name}"] = value if raw else str(value)
+        return dims
+
+    @staticmethod
+    async def exact_window(record: Record, filters: Dict[str, Any], start: datetime, end: datetime
+                           ) -> Tuple[int, Decimal]:
+        """
+        Count and amount sum of records in [start, end) from MongoDB, for the part of a window before its first
+        whole bucket
+        :param filters: `scene_dims(..., raw=True)`
+        :param start: naive UTC, as `Record.create_at`
+        :param end: naive UTC
+        """
+        if start >= end:
+            return 0, Decimal(0)
+        docs = await app.state.engine.get_collection(Record).aggregate([
+            {"$match": {"event": record.event, "create_at": {"$gte": start, "$lt": end}, **filters}},
+            {"$group": {"_id": None, "n": {"$sum": 1}, "s": {"$sum": "$event_data.amount"}}},
+        ]).to_list(None)
+        if not docs:
+            return 0, Decimal(0)
+        s = docs[0]['s']
+        return docs[0]['n'], s.to_decimal() if isinstance(s, Decimal128) else Decimal(str(s))
+
+    async def window(self, record: Record, kwargs: Dict[str, Operator], unit_of_time: timedelta,
+                     event_data_opt_names: Iterable[str] = (),
+                     user_opt_names: Iterable[str] = ()) -> Optional[Tuple[int, Decimal]]:
+        """
+        Count and amount sum of records in `unit_of_time`: whole buckets from redis, the part before the first
+        whole bucket from MongoDB
+        :return: (count, amount), None if the scene must query MongoDB
+        """
+        if not self.enable or unit_of_time.total_seconds() > WINDOW_MAX_SECONDS:
+            return None
+        filters = self.scene_dims(record, kwargs, event_data_opt_names, user_opt_names, raw=True)
+        if filters is None:
+            return None
+        dims = {k: str(v) for k, v in filters.items()}
+        if frozenset(dims) not in self.dimensions:
+            return None
+        now = time.time()
+        start = now - unit_of_time.total_seconds()
+        # first whole bucket
+        first = -int(-start // self.bucket_seconds)
+        try:
+            n, s = await self._script('sum', SUM_SCRIPT)(
+                keys=[self.key_prefix(record.event, dims)], args=[first, self.bucket(now)]
+            )
+            partial_n, partial_s = await self.exact_window(
+                record, filters, datetime.utcfromtimestamp(start),
+                datetime.utcfromtimestamp(min(first * self.bucket_seconds, now)))
+        except Exception as e:
+            self.logger.exceptions(e, where='window', record=record.id)
+            return None
+        if isinstance(s, bytes):
+            s = s.decode()
+        return int(n) + partial_n, Decimal(s) + partial_s
+
+    async def distinct(self, record: Record, kwargs: Dict[str, Operator], unit_of_time: timedelta,
+                       sketch: Sketch, threshold: int, max_error: float = 0,
+                       event_data_opt_names: Iterable[str] = (),
+                       user_opt_names: Iterable[str] = ()) -> Optional[int]:
+        """
+        Approximate distinct count of `sketch.element` in `unit_of_time`.
+        The estimate is only returned if the scene accepts HyperLogLog's error (`max_error`) and the estimate is
+        not within `max_error` of the scene's threshold, where the comparison could flip, so decisions near the
+        threshold are still made by an exact count.
+        :param threshold: number the scene compares the count with
+        :param max_error: relative error of the count the scene accepts, 0 to disable
+        :return: estimated count, None if the scene must count exactly in MongoDB
+        """
+        if not self.enable or max_error < HLL_STANDARD_ERROR or unit_of_time.total_seconds() > WINDOW_MAX_SECONDS:
+            return None
+        dims = self.scene_dims(record, kwargs, event_data_opt_names, user_opt_names)
+        if dims is None:
+            return None
+        if sketch.dimension not in dims:
+            value = self.record_value(record, sketch.dimension)
+            if value is None:
+                return None
+            dims[sketch.dimension] = str(value)
+        if frozenset(dims) not in sketch.dimensions:
+            return None
+
+        now = time.time()
+        prefix = self.key_prefix(record.event, dims, sketch)
+        first = self.bucket(now - unit_of_time.total_seconds(), self.sketch_bucket_seconds)
+        last = self.bucket(now, self.sketch_bucket_seconds)
+        try:
+            estimate = await app.state.a_redis.pfcount(*[f"{prefix}{b}" for b in range(first, last + 1)])
+        except Exception as e:
+            self.logger.exceptions(e, where='distinct', record=record.id)
+            return None
+        if not self.is_decisive(estimate, threshold, max_error):
+            return None
+        return estimate
+
+    @staticmethod
+    def is_decisive(estimate: int, threshold: int, max_error: float) -> bool:
+        """
+        Whether comparing `estimate` with `threshold` gives the same result as the exact count, which is within
+        `max_error * threshold` of the estimate near the threshold
+        """
+        return abs(estimate - threshold) > max_error * threshold
+
+
+window_store = WindowStore()
@@ -1,10 +1,14 @@
 # __author__ = "Mio"
 # __email__: "liurusi.101@gmail.com"
 # created: 5/12/21 7:41 PM
+import asyncio
+import hashlib
+import json
+
 from aioredis import Redis
 from bson import ObjectId
 from loguru import logger
-from typing import Optional, Union, Type, Dict, Any, List, Sequence
+from typing import Optional, Union, Type, Dict, Any, List, Sequence, Callable, Set
 
 # noinspection PyProtectedMember
 from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCursor
@@ -15,7 +19,17 @@ from pydantic.utils import lenient_issubclass
 from pymongo import ReturnDocument
 from pymongo.results import UpdateResult
 
-from config.clients import cached_instance
+from config import CACHE_INVALIDATION_CHANNEL, CACHE_NEGATIVE_TTL
+from config.clients import cached_instance, instance_cache_key
+from utils.cache import CachePolicy, LocalCache, SingleFlight, DEFAULT_CACHE_POLICY, NOT_FOUND, model_cache_version
+from utils.encoder import BsonSerializer
+from utils.query_planner import facet_batch
+
+
+# primary keys per L1 invalidation, UNLINK pipeline and invalidation message
+INVALIDATION_BATCH_SIZE = 1000
+# L1 keeps documents as raw BSON, every hit decodes its own copy
+L1_SERIALIZER = BsonSerializer(compression='')
 
 
 class YvoEngine(AIOEngine):
@@ -23,6 +37,15 @@ class YvoEngine(AIOEngine):
                  a_redis_client: Redis = None):
         super(YvoEngine, self).__init__(motor_client, database)
         self.a_redis_client = a_redis_client
+        self.local_caches: Dict[str, LocalCache] = {}
+        self._unique_fields: Dict[str, Set[str]] = {}
+        # one load per (model, primary key) at a time
+        self._loading = SingleFlight()
+        # called with (model name or None for all, primary keys or None for all) on every local or remote
+        # invalidation
+        self.invalidation_callbacks: List[Callable[[Optional[str], Optional[Sequence[str]]], None]] = []
+        # models cached by this process, by name
+        self.cached_models: Dict[str, Type[Model]] = {}
 
     @staticmethod
     def build_cache_key(instance):
@@ -96,19 +119,247 @@ class YvoEngine(AIOEngine):
 
     async def find(self, model: Type[ModelType], *args, **kwargs) -> List[ModelType]:
         motor_cursor = self._find(model, *args, **kwargs)
-        return [await self.get_by_id(model, self.get_doc_primary_key(doc, model)) async for doc in motor_cursor]
+        primary_keys = [self.get_doc_primary_key(doc, model) async for doc in motor_cursor]
+        return await self.get_by_ids(model, primary_keys)
+
+    def build_instance_cache_key(self, model: Type[ModelType], primary_key: Union[str, ObjectId]) -> str:
+        self.cached_models.setdefault(model.__name__, model)
+        return cached_instance.get_cache_key(
+            self._get_by_id, args=[self],
+            kwargs=dict(model=model, primary_key=str(primary_key))
+        )
+
+    @staticmethod
+    def cache_policy(model: Type[ModelType]) -> CachePolicy:
+        policy = getattr(model, 'cache_policy_', None)
+        return policy() if policy else DEFAULT_CACHE_POLICY
+
+    def local_cache(self, model: Type[ModelType]) -> Optional[LocalCache]:
+        policy = self.cache_policy(model)
+        if not policy.local:
+            return None
+        local_cache = self.local_caches.get(model.__name__)
+        if local_cache is None:
+            local_cache = self.local_caches[model.__name__] = LocalCache(ttl=policy.local_ttl,
+                                                                         maxsize=policy.local_size,
+                                                                         serializer=L1_SERIALIZER)
+        return local_cache
+
+    async def get_by_ids(self,
+                         model: Type[ModelType],
+                         primary_keys: Sequence[Union[str, ObjectId]],
+                         ) -> List[Optional[ModelType]]:
+        """
+        Bulk `get_by_id`: L1 first, one MGET for cached documents, one `$in` query for the misses and one MSET
+        to cache them
+        :param model:
+        :param primary_keys:
+        :return: instances in the order of `primary_keys`, None if not found
+        """
+        if not primary_keys:
+            return []
+        policy = self.cache_policy(model)
+        local_cache = self.local_cache(model)
+        keys = [str(pk) for pk in primary_keys]
+        docs: Dict[str, Optional[dict]] = {pk: local_cache.get(pk, None) if local_cache else None for pk in keys}
+
+        misses = [pk for pk, doc in docs.items() if doc is None]
+        cache_keys = {pk: self.build_instance_cache_key(model, pk) for pk in misses}
+        if misses and policy.remote:
+            try:
+                cached_docs = await cached_instance.cache.multi_get([cache_keys[pk] for pk in misses])
+            except Exception as e:
+                logger.exception(e)
+            else:
+                docs.update({pk: doc for pk, doc in zip(misses, cached_docs) if doc is not None})
+                if local_cache:
+                    for pk, doc in zip(misses, cached_docs):
+                        if doc is not None:
+                            local_cache.set(pk, doc, ttl=CACHE_NEGATIVE_TTL if doc == NOT_FOUND else None)
+                misses = [pk for pk in misses if docs[pk] is None]
+
+        if misses:
+            logger.info(f'real:get_info:{model.__name__}:{misses}')
+            _misses = [ObjectId(pk) for pk in misses] if model.__primary_field__ == 'id' else misses
+            collection = self.get_collection(model)
+            motor_cursor = collection.aggregate([{"$match": {"_id": {"$in": _misses}}}])
+            results = await AIOCursor(model, motor_cursor)
+            fetched = {str(getattr(instance, model.__primary_field__)): instance.dict() for instance in results}
+            docs.update(fetched)
+            if local_cache:
+                for pk, doc in fetched.items():
+                    local_cache.set(pk, doc)
+            if fetched and policy.remote:
+                try:
+                    await cached_instance.cache.multi_set(
+                        [(cache_keys[pk], doc) for pk, doc in fetched.items()], ttl=cached_instance.ttl)
+                except Exception as e:
+                    logger.exception(e)
+            not_found = [pk for pk in misses if pk not in fetched]
+            if not_found and CACHE_NEGATIVE_TTL:
+                await self.cache_not_found(model, not_found)
+        # noinspection PyTypeChecker
+        return [model.parse_obj(docs[pk]) if docs.get(pk) and docs[pk] != NOT_FOUND else None for pk in keys]
+
+    def unique_fields(self, model: Type[ModelType]) -> Set[str]:
+        """
+        Fields of the single field unique indexes declared by `model.index_()`
+        """
+        fields = self._unique_fields.get(model.__name__)
+        if fields is None:
+            fields = set()
+            index_ = getattr(model, 'index_', None)
+            for index in (index_() if index_ else []):
+                keys = list(index.document['key'])
+                if index.document.get('unique') and len(keys) == 1:
+                    fields.add(keys[0])
+            self._unique_fields[model.__name__] = fields
+        return fields
+
+    @staticmethod
+    def build_unique_cache_key(model: Type[ModelType], field: str, value) -> str:
+        # values may be secrets like Handler.token, keep them out of key names
+        return f"{model.__collection__}:U:{field}:{hashlib.sha1(str(value).encode()).hexdigest()}"
+
+    async def get_by_unique(self, model: Type[ModelType], field: str, value) -> Optional[ModelType]:
+        """
+        `find_one` by a unique field, cached as value -> primary key, the instance is got by `get_by_id`.
+        A cached primary key is checked against the instance, documents renamed or deleted since are looked up
+        again, so other processes don't need to invalidate the mapping.
+        :param model:
+        :param field: field of a unique index in `model.index_()`, otherwise it's a plain `find_one`
+        :param value:
+        :return:
+        """
+        policy = self.cache_policy(model)
+        if field not in self.unique_fields(model) or not (policy.local or policy.remote):
+            return await self.find_one(model, getattr(model, field) == value)
+
+        key = self.build_unique_cache_key(model, field, value)
+        local_cache = self.local_cache(model)
+        primary_key = local_cache.get(key, None) if local_cache else None
+        if primary_key is None and policy.remote:
+            try:
+                primary_key = await cached_instance.cache.get(key)
+            except Exception as e:
+                logger.exception(e)
+        if primary_key is not None:
+            instance = await self.get_by_id(model, primary_key)
+            if instance is not None and getattr(instance, field) == value:
+                if local_cache:
+                    local_cache.set(key, primary_key)
+                return instance
+            await self.delete_unique_cache(model, {field: value})
+
+        instance = await self.find_one(model, getattr(model, field) == value)
+        if instance is not None:
+            await self.set_unique_cache(model, [instance], field)
+        return instance
+
+    async def set_unique_cache(self, model: Type[ModelType], instances: Sequence[ModelType], field: str):
+        """
+        Cache value -> primary key mappings of `get_by_unique` for `instances`
+        """
+        policy = self.cache_policy(model)
+        local_cache = self.local_cache(model)
+        mappings = [
+            (self.build_unique_cache_key(model, field, getattr(instance, field)),
+             str(getattr(instance, model.__primary_field__)))
+            for instance in instances
+        ]
+        if local_cache:
+            for key, primary_key in mappings:
+                local_cache.set(key, primary_key)
+        if mappings and policy.remote:
+            try:
+                await cached_instance.cache.multi_set(mappings, ttl=cached_instance.ttl)
+            except Exception as e:
+                logger.exception(e)
+
+    async def delete_unique_cache(self, model: Type[ModelType], values: Dict[str, Any]):
+        """
+        Drop value -> primary key mappings of `get_by_unique`
+        :param model:
+        :param values: unique field -> value
+        """
+        policy = self.cache_policy(model)
+        local_cache = self.local_caches.get(model.__name__)
+        for field, value in values.items():
+            if value is None:
+                continue
+            key = self.build_unique_cache_key(model, field, value)
+            if local_cache:
+                local_cache.delete(key)
+            if policy.remote:
+                try:
+                    await cached_instance.cache.delete(key)
+                except Exception as e:
+                    logger.exception(e)
 
     async def get_by_id(self,
                         model: Type[ModelType],
                         primary_key: Union[str, ObjectId],
                         ) -> Optional[ModelType]:
-        _json = await self._get_by_id(model=model, primary_key=str(primary_key))
-        if _json:
+        primary_key = str(primary_key)
+        local_cache = self.local_cache(model)
+        _json = local_cache.get(primary_key, None) if local_cache else None
+        if _json is None:
+            # concurrent misses of one key wait for the same load, each decodes its own copy of it
+            _json = L1_SERIALIZER.loads(await self._loading.do(
+                (model.__name__, primary_key), lambda: self._load_by_id(model, primary_key)))
+        if _json and _json != NOT_FOUND:
             # noinspection PyTypeChecker
             return model.parse_obj(_json)
         else:
             return None
 
+    async def _load_by_id(self, model: Type[ModelType], primary_key: str) -> bytes:
+        """
+        Load a document missed by L1 from redis or MongoDB, documents not found are cached as `NOT_FOUND` for
+        CACHE_NEGATIVE_TTL seconds, saving the document drops it as any other cached one.
+        Not through the `_get_by_id` decorator, which would also cache None for a missing document.
+        :return: the document serialized by `L1_SERIALIZER`
+        """
+        local_cache = self.local_cache(model)
+        remote = self.cache_policy(model).remote
+        _json = None
+        if remote:
+            try:
+                _json = await cached_instance.cache.get(self.build_instance_cache_key(model, primary_key))
+            except Exception as e:
+                logger.exception(e)
+        if _json is None:
+            _json = await self._fetch_by_id(model=model, primary_key=primary_key)
+            if _json is not None and remote:
+                try:
+                    await cached_instance.cache.set(self.build_instance_cache_key(model, primary_key), _json,
+                                                    ttl=cached_instance.ttl)
+                except Exception as e:
+                    logger.exception(e)
+        if _json is None:
+            if CACHE_NEGATIVE_TTL:
+                await self.cache_not_found(model, [primary_key])
+        elif local_cache:
+            local_cache.set(primary_key, _json, ttl=CACHE_NEGATIVE_TTL if _json == NOT_FOUND else None)
+        return L1_SERIALIZER.dumps(_json)
+
+    async def cache_not_found(self, model: Type[ModelType], primary_keys: Sequence[str]):
+        policy = self.cache_policy(model)
+        local_cache = self.local_cache(model)
+        if local_cache:
+            for primary_key in primary_keys:
+                local_cache.set(primary_key, NOT_FOUND, ttl=CACHE_NEGATIVE_TTL)
+        if policy.remote:
+            # set if absent: a document cached by another process since it was found missing is kept
+            results = await asyncio.gather(*[
+                cached_instance.cache.add(self.build_instance_cache_key(model, pk), NOT_FOUND, ttl=CACHE_NEGATIVE_TTL)
+                for pk in primary_keys
+            ], return_exceptions=True)
+            for result in results:
+                # ValueError: the key exists
+                if isinstance(result, Exception) and not isinstance(result, ValueError):
+                    logger.exception(result)
+
     @cached_instance
     async def _get_by_id(
             self,
@@ -116,11 +367,18 @@ class YvoEngine(AIOEngine):
             primary_key: str,
     ) -> Optional[dict]:
         """
-
+        Defines the keys of `cached_instance` (see `build_instance_cache_key`), loads go through `_load_by_id`
         :param model:
         :param primary_key:
         :return: None时不缓存
         """
+        return await self._fetch_by_id(model=model, primary_key=primary_key)
+
+    async def _fetch_by_id(
+            self,
+            model: Type[ModelType],
+            primary_key: str,
+    ) -> Optional[dict]:
         logger.info(f'real:get_info:{model.__name__}:{primary_key}')
         _primary_key = ObjectId(primary_key) if model.__primary_field__ == 'id' else primary_key
         query = AIOEngine._build_query(getattr(model, model.__primary_field__) == _primary_key)
@@ -135,15 +393,185 @@ class YvoEngine(AIOEngine):
     async def delete_cache(self, instance: ModelType, model: Type[ModelType] = None):
         model = model or instance.__class__
         primary_key = self.get_doc_primary_key(instance, model or instance.__class__)
+        await self.delete_cache_by_key(model, primary_key)
+        unique_fields = self.unique_fields(model)
+        if unique_fields:
+            await self.delete_unique_cache(model, {
+                field: instance.get(field) if isinstance(instance, dict) else getattr(instance, field, None)
+                for field in unique_fields
+            })
 
-        key = cached_instance.get_cache_key(
-            self._get_by_id, args=[self],
-            kwargs=dict(model=model, primary_key=primary_key)
-        )
-        # if cached_instance.cache.namespace:
-        #     key = f"{cached_instance.cache.namespace}:{key}"
+    async def delete_cache_by_key(self, model: Type[ModelType], primary_key: Union[str, ObjectId]):
+        await self.delete_cache_by_keys(model, [primary_key])
 
-        await cached_instance.cache.delete(key)
+    def is_cached(self, model: Type[ModelType]) -> bool:
+        policy = self.cache_policy(model)
+        return policy.local or policy.remote
+
+    async def delete_cache_by_keys(self, model: Type[ModelType], primary_keys: Sequence[Union[str, ObjectId]]):
+        """
+        Invalidate instances by primary keys: L1 at once, redis keys by pipelined UNLINKs and one invalidation
+        message, per `INVALIDATION_BATCH_SIZE` keys
+        """
+        if not primary_keys or not self.is_cached(model):
+            return
+        for i in range(0, len(primary_keys), INVALIDATION_BATCH_SIZE):
+            keys = [str(pk) for pk in primary_keys[i:i + INVALIDATION_BATCH_SIZE]]
+            self.invalidate_local(model.__name__, keys)
+            if self.cache_policy(model).remote:
+                await self.unlink_cache_keys([self.build_instance_cache_key(model, pk) for pk in keys])
+            await self.publish_invalidation(model, keys)
+
+    async def unlink_cache_keys(self, keys: Sequence[str]):
+        """
+        Delete keys of `cached_instance` in one round-trip
+        """
+        if self.a_redis_client is None:
+            for key in keys:
+                await cached_instance.cache.delete(key)
+            return
+        namespace = cached_instance.cache.namespace
+        async with self.a_redis_client.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.unlink(f"{namespace}:{key}" if namespace else key)
+            await pipe.execute()
+
+    @staticmethod
+    def primary_keys_of_query(query) -> Optional[List]:
+        """
+        Primary keys a RAW or built query is restricted to, by `_id` equality or `$in`
+        :return: None if the query doesn't restrict `_id`
+        """
+        if not isinstance(query, dict):
+            return None
+        if '_id' in query:
+            cond = query['_id']
+            if not isinstance(cond, dict):
+                return [cond]
+            if set(cond) == {'$eq'}:
+                return [cond['$eq']]
+            if set(cond) == {'$in'}:
+                return list(cond['$in'])
+            return None
+        for clause in query.get('$and', []):
+            primary_keys = YvoEngine.primary_keys_of_query(clause)
+            if primary_keys is not None:
+                return primary_keys
+        return None
+
+    async def cached_keys_of_query(self, model: Type[ModelType], query: dict, limit: int = 0) -> List:
+        """
+        Primary keys to invalidate after a write by `query`, read before the write: keys in the query are used as
+        they are, otherwise only `_id`s are read, without loading or caching the documents
+        :return: empty if `model` isn't cached
+        """
+        if not self.is_cached(model):
+            return []
+        primary_keys = self.primary_keys_of_query(query)
+        if primary_keys is not None:
+            return primary_keys
+        return [doc['_id'] async for doc in self.get_collection(model).find(query, projection={"_id": 1},
+                                                                             limit=limit)]
+
+    async def publish_invalidation(self, model: Type[ModelType], primary_keys: Sequence[Union[str, ObjectId]]):
+        """
+        Tell other workers and services to drop the instances from their L1 caches and derived data
+        """
+        policy = self.cache_policy(model)
+        if not self.a_redis_client or not (policy.local or policy.remote):
+            # not cached anywhere
+            return
+        await self._publish_invalidation({
+            "model": model.__name__, "version": model_cache_version(model), "keys": [str(pk) for pk in primary_keys]
+        })
+
+    async def _publish_invalidation(self, message: dict):
+        try:
+            await self.a_redis_client.publish(CACHE_INVALIDATION_CHANNEL, json.dumps(message))
+        except Exception as e:
+            logger.exception(e)
+
+    async def clear_cache(self, model: Optional[Type[ModelType]] = None) -> int:
+        """
+        Drop all cached instances of `model`, of all models if None, in redis (every cache version) and in the
+        L1 of every process. For admins, restarts don't need it as cache keys are versioned.
+        :return: number of redis keys deleted
+        """
+        namespace = cached_instance.cache.namespace
+        pattern = instance_cache_key(model.__name__ if model else '*', '*', '*')
+        deleted, keys = 0, []
+        async for key in self.a_redis_client.scan_iter(match=f"{namespace}:{pattern}" if namespace else pattern,
+                                                       count=INVALIDATION_BATCH_SIZE):
+            keys.append(key)
+            if len(keys) >= INVALIDATION_BATCH_SIZE:
+                deleted += await self.a_redis_client.unlink(*keys)
+                keys = []
+        if keys:
+            deleted += await self.a_redis_client.unlink(*keys)
+        model_name = model.__name__ if model else None
+        self.invalidate_local(model_name, None)
+        await self._publish_invalidation({"model": model_name, "keys": None})
+        logger.info(f"cache:cleared:{model_name or 'all'}:{deleted}")
+        return deleted
+
+    def invalidate_local(self, model_name: Optional[str], primary_keys: Optional[Sequence[str]] = ()):
+        """
+        Drop instances from L1 and notify `invalidation_callbacks`
+        :param model_name: None for all models
+        :param primary_keys: None for all instances of the model
+        """
+        if model_name is None:
+            for local_cache in self.local_caches.values():
+                local_cache.clear()
+        else:
+            local_cache = self.local_caches.get(model_name)
+            if local_cache and primary_keys is None:
+                local_cache.clear()
+            elif local_cache:
+                for key in primary_keys:
+                    local_cache.delete(key)
+        for callback in self.invalidation_callbacks:
+            try:
+                callback(model_name, primary_keys)
+            except Exception as e:
+                logger.exception(e)
+
+    async def listen_invalidation(self):
+        """
+        Drop instances invalidated by other processes from L1, run as a task for the life of the engine.
+        L1 is cleared after the subscription is (re)established, messages may have been lost in between.
+        """
+        while True:
+            try:
+                pubsub = self.a_redis_client.pubsub()
+                await pubsub.subscribe(CACHE_INVALIDATION_CHANNEL)
+                self.invalidate_local(None)
+                async for message in pubsub.listen():
+                    if message.get('type') != 'message':
+                        continue
+                    data = json.loads(message['data'])
+                    self.invalidate_local(data.get('model'), data.get('keys', []))
+                    await self.invalidate_other_version(data)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(e)
+                await asyncio.sleep(1)
+
+    async def invalidate_other_version(self, data: dict):
+        """
+        While processes with another version of a model are running, e.g. in a rolling update, their
+        invalidations only delete the keys of their version, delete the keys of this process's version as well
+        """
+        model = self.cached_models.get(data.get('model'))
+        version, keys = data.get('version'), data.get('keys')
+        if not model or not version or not keys or not self.cache_policy(model).remote:
+            return
+        if version != model_cache_version(model):
+            await self.unlink_cache_keys([self.build_instance_cache_key(model, pk) for pk in keys])
+
+    # Caches are invalidated after writes: an invalidation before the write lets readers, e.g. the ruleset
+    # snapshot rebuilt on the invalidation message, cache the old document again.
 
     async def save(self, instance: ModelType) -> ModelType:
         """
@@ -151,19 +579,19 @@ class YvoEngine(AIOEngine):
         :param instance:
         :return:
         """
-        await self.delete_cache(instance)
         instance = await super(YvoEngine, self).save(instance=instance)
+        await self.delete_cache(instance)
         return instance
 
     async def save_all(self, instances: Sequence[ModelType]) -> List[ModelType]:
-        for ai in instances:
-            await self.delete_cache(ai)
         added_instances = await super(YvoEngine, self).save_all(instances=instances)
+        for ai in added_instances:
+            await self.delete_cache(ai)
         return added_instances
 
     async def delete(self, instance: ModelType) -> None:
-        await self.delete_cache(instance)
         await super(YvoEngine, self).delete(instance=instance)
+        await self.delete_cache(instance)
 
     async def yvo_pipeline(self, model: Type[ModelType], *queries, pipeline: List[Dict] = None) -> List[Dict]:
         if not pipeline:
@@ -176,40 +604,40 @@ class YvoEngine(AIOEngine):
             _pipeline = pipeline
         # logger.info(f"pipeline::{_pipeline}")
         collection = self.get_collection(model)
+        batch = facet_batch.get()
+        if batch is not None and queries:
+            # merged with other scenes of the rule, see `utils.query_planner`
+            return await batch.aggregate(collection, query, pipeline)
         motor_cursor = collection.aggregate(_pipeline)
         return [doc async for doc in motor_cursor]
 
     async def update_many(self, model: Type[ModelType], *queries, update: Union[List[Dict], Dict] = None) -> UpdateResult:
-        motor_cursor = self._find(model, *queries)
-        async for doc in motor_cursor:
-            await self.delete_cache(doc, model)
+        query = AIOEngine._build_query(*queries)
+        primary_keys = await self.cached_keys_of_query(model, query)
 
         collection = self.get_collection(model)
-        query = AIOEngine._build_query(*queries)
         logger.debug(f"update_many::{query}::{update}")
-        return await collection.update_many(filter=query, update=update)
+        rst = await collection.update_many(filter=query, update=update)
+        await self.delete_cache_by_keys(model, primary_keys)
+        return rst
 
     async def update_one(self, model: Type[ModelType], query, update: Union[List[Dict], Dict] = None) -> UpdateResult:
-        instance = await self.find_one(model, query)
-        if instance:
-            await self.delete_cache(instance, model)
+        primary_keys = await self.cached_keys_of_query(model, query, limit=1)
 
         collection = self.get_collection(model)
         # IMPORTANT For AWS DocumentDB updateOne cannot use queries builder
         # IMPORTANT use RAW query directly for multi queries, or kwargs style query for ONE query like Record.id == xxx
         # query = AIOEngine._build_query(*queries)
         # logger.debug(f"update_one::{query}::{update}")
-        return await collection.update_one(filter=query, update=update)
+        rst = await collection.update_one(filter=query, update=update)
+        await self.delete_cache_by_keys(model, primary_keys)
+        return rst
 
     async def find_one_and_update(self,
                                   model: Type[ModelType],
                                   query,
                                   update: List[Dict] = None,
                                   return_document=ReturnDocument.AFTER) -> Optional[ModelType]:
-        instance = await self.find_one(model, query)
-        if instance:
-            await self.delete_cache(instance, model)
-
         collection = self.get_collection(model)
         # IMPORTANT For AWS DocumentDB updateOne cannot use queries builder
         # IMPORTANT use RAW query directly for multi queries, or kwargs style query for ONE query like Record.id == xxx
@@ -218,14 +646,41 @@ class YvoEngine(AIOEngine):
         rst = await collection.find_one_and_update(filter=query, update=update, return_document=return_document)
         if rst:
             primary_key = self.get_doc_primary_key(rst, model)
+            await self.delete_cache_by_key(model, primary_key)
+            if return_document == ReturnDocument.AFTER:
+                return model.parse_doc(rst)
             return await self.get_by_id(model, primary_key=primary_key)
 
+    async def find_one_and_update_by_id(self,
+                                        model: Type[ModelType],
+                                        primary_key: Union[str, ObjectId],
+                                        update: Union[List[Dict], Dict],
+                                        query: Optional[Dict] = None,
+                                        return_document=ReturnDocument.AFTER) -> Optional[ModelType]:
+        """
+        `find_one_and_update` of a known primary key in one round-trip: the cache is invalidated by key instead of
+        reading the document first, and the returned document is parsed instead of fetched again.
+        :param model:
+        :param primary_key:
+        :param update: update document or aggregation pipeline
+        :param query: RAW query besides the primary key
+        :param return_document:
+        :return:
+        """
+        collection = self.get_collection(model)
+        rst = await collection.find_one_and_update(
+            filter={"_id": primary_key, **(query or {})}, update=update, return_document=return_document)
+        await self.delete_cache_by_key(model, primary_key)
+        if rst:
+            return model.parse_doc(rst)
+        return None
+
     async def delete_many(self, model: Type[ModelType], *queries):
-        motor_cursor = self._find(model, *queries)
-        async for doc in motor_cursor:
-            await self.delete_cache(doc)
+        query = AIOEngine._build_query(*queries)
+        primary_keys = await self.cached_keys_of_query(model, query)
 
         collection = self.get_collection(model)
-        query = AIOEngine._build_query(*queries)
         logger.debug(f"delete_many::{query}")
-        return await collection.delete_many(filter=query)
+        rst = await collection.delete_many(filter=query)
+        await self.delete_cache_by_keys(model, primary_keys)
+        return rst